@@ -9,7 +9,8 @@
 
 
 #import statements
-import sys, os
+import sys, os, time, argparse, collections, csv, json, socket, atexit, hashlib, zipfile
+import concurrent.futures
 
 try:
     import numpy as np
@@ -74,8 +75,13 @@ simulation_properties['smoke_diff_away_blue'] = 0.99
 simulation_properties['temp_diff_away'] = 0.99
 simulation_properties['N'] = 50
 simulation_properties['linear_solver_tries'] = 20
+simulation_properties['linear_solver_mode'] = 'relaxation' # 'spectral' solves project() and diffuse() exactly with numpy.fft on fully periodic domains
 simulation_properties['vorticity_confinement_constant'] = 0.005 #NOTE: this was 0.00005 earlier, so this value hasn't been tested as thoroughly
 simulation_properties['size'] = simulation_properties['N'] + 2 # size includes two boundaries cells
+# boundary mode of each edge of the box: 'wall', 'periodic' (left/right and bottom/top must be periodic together),
+# 'inflow' (velocity prescribed by inflow_velocity) or 'outflow' (open edge that smoke and fluid can leave through)
+simulation_properties['boundary_modes'] = {'left':'wall','right':'wall','bottom':'wall','top':'wall'}
+simulation_properties['inflow_velocity'] = {'left':(0.0,0.0),'right':(0.0,0.0),'bottom':(0.0,0.0),'top':(0.0,0.0)} # (u,v) on inflow edges
 size = simulation_properties['size']
 
 # for numerical stability reasons, float64 is highly recommended for velocity data
@@ -97,6 +103,72 @@ simulation_data['blue_dens_prev'] = np.zeros(shape=(size,size), dtype=(np.float6
 simulation_data['temp'] = np.zeros(shape=(size,size), dtype=(np.float64))
 simulation_data['temp_prev'] = np.zeros(shape=(size,size), dtype=(np.float64))
 
+#####################
+# obstacle properties
+# internal solid obstacles: a static mask (loaded from an image or an array) plus moving rectangles and circles
+# the obstacles are rasterised onto the cell grid and turned into precomputed index arrays so that set_bnd() can
+# enforce them with a few fancy-indexed assignments instead of branching on every cell
+#####################
+obstacle_properties = {}
+obstacle_properties['static_source'] = None # boolean array indexed [x,y] at any resolution, resampled onto the grid when rebuilding
+obstacle_properties['shapes'] = [] # moving rectangles and circles, see add_obstacle_rect() and add_obstacle_circle()
+obstacle_properties['slip'] = 'free' # 'free' behaves like the outer walls in set_bnd(), 'no' makes the obstacle surface drag the fluid along
+obstacle_properties['dirty'] = True # the whole mask and all index arrays are rebuilt when this is set, see build_obstacle_index()
+obstacle_properties['static'] = np.zeros(shape=(size,size), dtype=bool) # static_source resampled onto the grid
+obstacle_properties['solid'] = np.zeros(shape=(size,size), dtype=bool)
+obstacle_properties['fluid'] = np.ones(shape=(size,size), dtype=(np.float64)) # 0.0 in solid cells, used to mask the divergence
+obstacle_properties['velocity'] = np.zeros(shape=(2,size,size), dtype=(np.float64)) # (u,v) of the obstacle covering each solid cell
+obstacle_properties['solid_count'] = 0
+obstacle_properties['index'] = {} # precomputed index arrays for the 'cell', 'u' and 'v' grids, see rebuild_obstacles()
+
+# cached Fourier-space denominators for the spectral solver, recomputed when N changes
+spectral_properties = {}
+spectral_properties['N'] = None
+spectral_properties['eigenvalues'] = None # eigenvalues of the 5-point Laplacian, 4 - 2cos(kx) - 2cos(ky)
+spectral_properties['pressure_inverse'] = None # inverse symbol of the pressure operator of project(), sin^2(kx) + sin^2(ky)
+
+#####################
+# volume properties
+# the 3D variant of the solver for volumetric smoke. It repeats the 2D steps with a third velocity component w,
+# keeps u, v and w on a staggered (MAC) grid with the extra face only along their own axis, and runs its stencils
+# slab by slab (ranges of x) on a thread pool; numpy releases the GIL inside its array loops so the slabs run in parallel
+#####################
+volume_properties = {}
+volume_properties['enabled'] = False # set by --3d, the GLUT window then shows one z slice of the volume
+volume_properties['N'] = 32 # cells per side, the 3D grids have N^3 interior cells
+volume_properties['dtype'] = np.float64 # np.float32 halves the memory and bandwidth of every 3D grid
+volume_properties['threads'] = os.cpu_count() or 1
+volume_properties['executor'] = None # thread pool running the slabs, created by allocate_volume()
+volume_properties['slice'] = 17 # z index of the slice shown in the GLUT window
+volume_properties['chunk_cells'] = 1 << 16 # cells advected at a time by each slab, this sizes the scratch arrays of advect_slab3D()
+volume_data = {} # 3D grids, allocated by allocate_volume()
+
+#####################
+# diagnostics properties
+# per-step physical statistics so runs can be monitored without watching them, see record_diagnostics()
+#####################
+diagnostics_properties = {}
+diagnostics_properties['every'] = 0 # record every n-th step, 0 turns diagnostics off
+diagnostics_properties['step'] = 0
+diagnostics_properties['records'] = collections.deque(maxlen=1000) # ring buffer of the most recent records
+diagnostics_properties['cfl_limit'] = 1.0 # records above this CFL number (or with non-finite fields) are flagged as blow-ups
+diagnostics_properties['warned'] = False # the blow-up warning is only printed once
+diagnostics_properties['buffers'] = {} # scratch arrays reused from one record to the next
+diagnostics_properties['output'] = None # CSV (.csv) or JSON lines file written when the program exits
+diagnostics_properties['server'] = None # listening socket on localhost for external monitors
+diagnostics_properties['clients'] = []
+
+#####################
+# replay properties
+# deterministic record/replay of the inputs to the solver, used to check that solver changes don't change the simulation
+#####################
+replay_properties = {}
+replay_properties['recording'] = None # the recording in progress, see start_recording()
+replay_properties['checkpoint_every'] = 10 # steps between field hashes and golden snapshots
+replay_properties['fields'] = ['u','v','red_dens','green_dens','blue_dens','temp'] # fields hashed and compared at checkpoints
+replay_properties['tolerances'] = {'u':1e-9,'v':1e-9,'red_dens':1e-6,'green_dens':1e-6,'blue_dens':1e-6,'temp':1e-6} # largest absolute difference accepted on replay
+replay_properties['gui_inputs'] = ['MOUSE_DOWN','MOUSE_X','MOUSE_Y','ORIG_MOUSE_X','ORIG_MOUSE_Y','SCREEN_WIDTH','SCREEN_HEIGHT','SMOKE_COLOR'] # what get_from_UI() reads
+
 #######################################################
 ### properties for the thorpy/pygame gui interface #####
 ### and some things related to the OpenGL window   #####
@@ -131,18 +203,92 @@ gui_properties['SCREEN'] = None # The pygame display for the toolbox, this will
 gui_properties['THORPY_ELEMENTS'] = dict() # to be populated with the Thorpy elements for the toolbox
 gui_properties['DISPLAY_VELOCITY'] = False
 gui_properties['CLOCK'] = pygame.time.Clock()
+gui_properties['VELOCITY_MODE'] = 'glyphs' # how velocity is displayed: 'glyphs', 'streamlines' or 'lic' (line integral convolution)
+gui_properties['VELOCITY_COLOR_BY_MAGNITUDE'] = False # otherwise the velocity display uses the smoke color
+gui_properties['GLYPH_SPACING'] = 8 # minimum distance in pixels between velocity glyphs, cells in between are skipped
+gui_properties['STREAMLINE_STEPS'] = 10 # integration steps (line segments) per streamline
+gui_properties['LIC_STEPS'] = 10 # samples taken in each direction along the flow for every LIC texel
+gui_properties['VELOCITY_BUFFERS'] = {} # vertex, color and texture arrays reused from frame to frame
+gui_properties['LIC_TEXTURE'] = None # OpenGL texture name, created the first time the LIC mode is drawn
+gui_properties['TOOLBOX_DIRTY_RECTS'] = [] # areas of the toolbox to redraw and push to the display on the next frame
+# thorpy sliders and the parameter each one feeds into the parameter store
+gui_properties['SLIDER_PARAMETERS'] = {'viscosity_slider':'VISC_SLIDER_VALUE',
+                                       'force_slider':'force',
+                                       'red_buoyancy_slider':'temp_source_red',
+                                       'green_buoyancy_slider':'temp_source_green',
+                                       'blue_buoyancy_slider':'temp_source_blue',
+                                       'red_dissipation_slider':'smoke_diff_away_red',
+                                       'green_dissipation_slider':'smoke_diff_away_green',
+                                       'blue_dissipation_slider':'smoke_diff_away_blue'}
+
+#####################
+# parameter store
+# values set from the GUI go through here. Listeners only run for values that actually changed,
+# and at most once per frame however many events arrived, see flush_parameters()
+#####################
+parameter_store = {}
+parameter_store['values'] = {}
+parameter_store['listeners'] = {} # parameter name -> list of functions called with the new value
+parameter_store['pending'] = [] # parameters changed since the last flush, in order of first change
+
+def set_parameter(name, value):
+    if name in parameter_store['values'] and parameter_store['values'][name] == value:
+        return
+    parameter_store['values'][name] = value
+    if name not in parameter_store['pending']:
+        parameter_store['pending'].append(name)
+
+def subscribe_parameter(name, listener):
+    parameter_store['listeners'].setdefault(name, []).append(listener)
+
+# notifies the listeners of every parameter that changed since the last call, once per parameter
+def flush_parameters():
+    pending, parameter_store['pending'] = parameter_store['pending'], []
+    for name in pending:
+        for listener in parameter_store['listeners'].get(name, []):
+            listener(parameter_store['values'][name])
+
+# the viscosity slider is exponential so that small viscosities can be chosen precisely
+def set_visc_from_slider(value):
+    gui_properties['VISC_SLIDER_VALUE'] = value
+    simulation_properties['visc'] = (np.exp(value/100)-1)/(np.exp(10)*70)
+
+# returns a listener that copies a slider value (divided by scale) into simulation_properties[name]
+def simulation_property_listener(name, scale=1):
+    def listener(value):
+        simulation_properties[name] = value/scale if scale != 1 else value
+    return listener
+
+subscribe_parameter('VISC_SLIDER_VALUE', set_visc_from_slider)
+subscribe_parameter('force', simulation_property_listener('force', 50))
+for name in ['temp_source_red','temp_source_green','temp_source_blue','smoke_diff_away_red','smoke_diff_away_green','smoke_diff_away_blue']:
+    subscribe_parameter(name, simulation_property_listener(name))
+
+# marks an area of the toolbox (the whole toolbox if rect is None) to be redrawn on the next frame
+def mark_toolbox_dirty(rect=None):
+    if rect is None:
+        rect = (0,0,gui_properties['TOOLBOX_WIDTH'],gui_properties['TOOLBOX_HEIGHT'])
+    gui_properties['TOOLBOX_DIRTY_RECTS'].append(pygame.Rect(rect))
+
+# the area covered by a line in PYGAME_ELEMENTS, including its width
+def line_rect(line):
+    left, top = min(line['start'][0], line['end'][0]), min(line['start'][1], line['end'][1])
+    right, bottom = max(line['start'][0], line['end'][0]), max(line['start'][1], line['end'][1])
+    return (left - line['width'], top - line['width'], right - left + 2*line['width'], bottom - top + 2*line['width'])
 
 #adds a gray rectangle to bottom because I can't call screen fill with a thorpy menu
 #must call this before color box rectangles so that it's first in the list of things rects to draw
 def bottom_screen_rectangle():
     PYGAME_ELEMENTS,TOOLBOX_COLOR,TOOLBOX_WIDTH = gui_properties['PYGAME_ELEMENTS'],gui_properties['TOOLBOX_COLOR'],gui_properties['TOOLBOX_WIDTH']
     PYGAME_ELEMENTS['rect'].append({'color':TOOLBOX_COLOR,'rect':(0,0,TOOLBOX_WIDTH,53)})
+    mark_toolbox_dirty((0,0,TOOLBOX_WIDTH,53))
 
 # add color boxes to PYGAME_ELEMENTS
 def add_color_boxes():
     COLOR_BOX_COLORS,PYGAME_ELEMENTS,COLOR_BOX_RECT_TUPLES = gui_properties['COLOR_BOX_COLORS'],gui_properties['PYGAME_ELEMENTS'],gui_properties['COLOR_BOX_RECT_TUPLES']
     for i,color in enumerate(COLOR_BOX_COLORS):
         PYGAME_ELEMENTS['rect'].append({'color':color,'rect':COLOR_BOX_RECT_TUPLES[i]})
+        mark_toolbox_dirty(COLOR_BOX_RECT_TUPLES[i])
 
 #draws a black box around the selected color box
 # some of this code is extraneous because an earlier version used outlines of other colors as well
@@ -150,6 +296,8 @@ def color_box_outline(surface,rect,width=3,color=(20,20,20),line='double_click')
 
     PYGAME_ELEMENTS = gui_properties['PYGAME_ELEMENTS']
 
+    for old_line in PYGAME_ELEMENTS['line_'+line]: # the old outline has to be painted over
+        mark_toolbox_dirty(line_rect(old_line))
     PYGAME_ELEMENTS['line_'+line] = [];
     #two adjacent points (including wrap back to beginning) make an edge of the rectangle
     positions = [(rect[0],rect[1]),
@@ -162,6 +310,7 @@ def color_box_outline(surface,rect,width=3,color=(20,20,20),line='double_click')
                                         'width':width})
     for i in range(len(positions)):
         pygame.draw.line(surface, color, positions[i], positions[(i+1)%len(positions)], width)
+        mark_toolbox_dirty(line_rect(PYGAME_ELEMENTS['line_'+line][i]))
 
 
 # returns True if a position pair is within a 4-tuple defining a pygame rect
@@ -179,6 +328,7 @@ def pygame_interface():
 
     gui_properties['SCREEN'] = pygame.display.set_mode((TOOLBOX_WIDTH,TOOLBOX_HEIGHT))
     gui_properties['SCREEN'].fill(TOOLBOX_COLOR)
+    mark_toolbox_dirty()
 
     # double-clickable color boxes for changing smoke color
     # white, red, green, blue
@@ -248,6 +398,10 @@ def make_thorpy_interface():
     TE['central_box'].blit()
     TE['central_box'].update()
 
+    for slider,name in gui_properties['SLIDER_PARAMETERS'].items(): # start the store from the values the sliders show
+        set_parameter(name, TE[slider].get_value())
+    flush_parameters()
+
 
 def pygame_init_function():
 
@@ -255,17 +409,24 @@ def pygame_init_function():
     make_thorpy_interface()
 
 
+# handles the toolbox once per frame. When the user is idle this only drains the (empty) event queue:
+# the color boxes are redrawn only where marked dirty and the sliders are only read after events
 def pygame_idle_function():
 
-    for geo_type,geo_list in gui_properties['PYGAME_ELEMENTS'].items():
-        if geo_type == 'rect':
-            for geo_instance in geo_list:
-                pygame.draw.rect(gui_properties['SCREEN'],geo_instance['color'],geo_instance['rect'])
-        if geo_type.find('line') > -1:
-            for geo_instance in geo_list:
-                pygame.draw.line(gui_properties['SCREEN'], geo_instance['color'], geo_instance['start'], geo_instance['end'], geo_instance['width'])
-    pygame.display.update()
-    gui_properties['THORPY_ELEMENTS']['central_box'].update()
+    dirty_rects = gui_properties['TOOLBOX_DIRTY_RECTS']
+    if dirty_rects:
+        for geo_type,geo_list in gui_properties['PYGAME_ELEMENTS'].items():
+            if geo_type == 'rect':
+                for geo_instance in geo_list:
+                    pygame.draw.rect(gui_properties['SCREEN'],geo_instance['color'],geo_instance['rect'])
+            if geo_type.find('line') > -1:
+                for geo_instance in geo_list:
+                    pygame.draw.line(gui_properties['SCREEN'], geo_instance['color'], geo_instance['start'], geo_instance['end'], geo_instance['width'])
+        central_box_rect = pygame.Rect(0,53,gui_properties['TOOLBOX_WIDTH'],gui_properties['TOOLBOX_HEIGHT']-53) # the thorpy box sits below the color boxes
+        if any(rect.colliderect(central_box_rect) for rect in dirty_rects):
+            gui_properties['THORPY_ELEMENTS']['central_box'].blit()
+        pygame.display.update(dirty_rects)
+        gui_properties['TOOLBOX_DIRTY_RECTS'] = []
 
     #clicking a color box (single click)
     if gui_properties['COLOR_BOX_EVENT']:
@@ -275,20 +436,14 @@ def pygame_idle_function():
             gui_properties['SMOKE_COLOR'] = gui_properties['COLOR_BOX_COLORS'][gui_properties['SELECTED_COLOR_INDEX_SINGLE_CLICK']]
             gui_properties['COLOR_BOX_EVENT'] = None
 
-    for event in pygame.event.get():
-
-        gui_properties['VISC_SLIDER_VALUE'] = gui_properties['THORPY_ELEMENTS']['viscosity_slider'].get_value()
-        simulation_properties['visc'] = (np.exp(gui_properties['VISC_SLIDER_VALUE']/100)-1)/(np.exp(10)*70)
-        simulation_properties['force'] = gui_properties['THORPY_ELEMENTS']['force_slider'].get_value()/50
-        simulation_properties['temp_source_red'] = gui_properties['THORPY_ELEMENTS']['red_buoyancy_slider'].get_value()
-        simulation_properties['temp_source_green'] = gui_properties['THORPY_ELEMENTS']['green_buoyancy_slider'].get_value()
-        simulation_properties['temp_source_blue'] = gui_properties['THORPY_ELEMENTS']['blue_buoyancy_slider'].get_value()
-        simulation_properties['smoke_diff_away_red'] = gui_properties['THORPY_ELEMENTS']['red_dissipation_slider'].get_value()
-        simulation_properties['smoke_diff_away_green'] = gui_properties['THORPY_ELEMENTS']['green_dissipation_slider'].get_value()
-        simulation_properties['smoke_diff_away_blue'] = gui_properties['THORPY_ELEMENTS']['blue_dissipation_slider'].get_value()
+    events = pygame.event.get()
+    for event in events:
 
         gui_properties['THORPY_ELEMENTS']['menu'].react(event) #thorpy events
 
+        if event.type == pygame.VIDEOEXPOSE: # the toolbox was uncovered
+            mark_toolbox_dirty()
+
         #clicking a color box (double click)
         if event.type == 5:
             for i,rect in enumerate(gui_properties['COLOR_BOX_RECT_TUPLES']):
@@ -315,6 +470,7 @@ def pygame_idle_function():
                 gui_properties['COLOR_BOX_COLORS'][gui_properties['SELECTED_COLOR_INDEX_DOUBLE_CLICK']] = gui_properties['THORPY_ELEMENTS']['cs'].get_color()
                 if gui_properties['SELECTED_COLOR_INDEX_DOUBLE_CLICK'] == gui_properties['SELECTED_COLOR_INDEX_SINGLE_CLICK']: # we also have to update the smoke color
                     gui_properties['SMOKE_COLOR'] = gui_properties['COLOR_BOX_COLORS'][gui_properties['SELECTED_COLOR_INDEX_SINGLE_CLICK']]
+                gui_properties['PYGAME_ELEMENTS']['rect'] = [] # replaced below, rather than stacking a new copy on every click
                 bottom_screen_rectangle()
                 add_color_boxes()
                 color_box_outline(gui_properties['SCREEN'],gui_properties['COLOR_BOX_RECT_TUPLES'][gui_properties['SELECTED_COLOR_INDEX_DOUBLE_CLICK']])
@@ -331,9 +487,17 @@ def pygame_idle_function():
         if event.type == pygame.QUIT:
             exit()
 
+    # a burst of events costs one read of each slider and one recomputation of whatever changed
+    if events:
+        for slider,name in gui_properties['SLIDER_PARAMETERS'].items():
+            set_parameter(name, gui_properties['THORPY_ELEMENTS'][slider].get_value())
+        flush_parameters()
+        gui_properties['THORPY_ELEMENTS']['central_box'].update()
+
 # clears velocity/density/temp data to "restart" simulation
 def clear_data():
 
+    record_event('clear')
     simulation_data['u'][:] = 0.0
     simulation_data['v'][:] = 0.0
     simulation_data['u_prev'][:]= 0.0
@@ -348,6 +512,8 @@ def clear_data():
     simulation_data['blue_dens_prev'][:] = 0.0
     simulation_data['temp'][:] = 0.0
     simulation_data['temp_prev'][:] = 0.0
+    for key in volume_data:
+        volume_data[key][:] = 0.0
 
 
 def pre_display():
@@ -368,30 +534,181 @@ def post_display():
 
 
 
-def draw_velocity():
+# draws the velocity field in the current VELOCITY_MODE
+# the 3D solver passes the u and v faces of its z slice, which are always drawn as glyphs
+def draw_velocity(u=None, v=None, N=None):
 
-    N = simulation_properties['N']
-    h = 1.0 / N
-    SMOKE_COLOR = gui_properties['SMOKE_COLOR']
+    if u is not None:
+        vertices, colors = glyph_segments(u, v, N)
+    elif gui_properties['VELOCITY_MODE'] == 'lic':
+        draw_velocity_lic()
+        return
+    elif gui_properties['VELOCITY_MODE'] == 'streamlines':
+        vertices, colors = streamline_segments()
+    else:
+        vertices, colors = glyph_segments()
 
-    glColor3f(1.0, 1.0, 1.0)
     glLineWidth(1.0)
+    glEnableClientState(GL_VERTEX_ARRAY)
+    glEnableClientState(GL_COLOR_ARRAY)
+    glVertexPointer(2, GL_FLOAT, 0, vertices)
+    glColorPointer(3, GL_FLOAT, 0, colors)
+    glDrawArrays(GL_LINES, 0, len(vertices))
+    glDisableClientState(GL_COLOR_ARRAY)
+    glDisableClientState(GL_VERTEX_ARRAY)
+
+
+# returns a float32 array reused between frames, reallocated only when the shape changes
+# (also holds the vertices of the obstacles, see draw_obstacles())
+def velocity_buffer(name, shape):
+    buffers = gui_properties['VELOCITY_BUFFERS']
+    if name not in buffers or buffers[name].shape != shape:
+        buffers[name] = np.zeros(shape=shape, dtype=(np.float32))
+    return buffers[name]
+
+
+# only every stride-th cell gets a glyph or streamline so that they stay GLYPH_SPACING pixels apart on screen
+def velocity_stride(N):
+    pixels_per_cell = min(gui_properties['SCREEN_WIDTH'], gui_properties['SCREEN_HEIGHT']) / N
+    return max(1, int(np.ceil(gui_properties['GLYPH_SPACING'] / pixels_per_cell)))
+
+
+# fills colors (one RGB row per vertex, given as an array of shape (...,3)) with the smoke color,
+# or with a blue to red ramp of the speed when coloring by magnitude
+def velocity_colors(colors, speed):
+    if gui_properties['VELOCITY_COLOR_BY_MAGNITUDE']:
+        t = speed / max(speed.max(), 1e-12)
+        colors[..., 0] = t
+        colors[..., 1] = 1 - np.absolute(2*t - 1)
+        colors[..., 2] = 1 - t
+    else:
+        colors[...] = np.array(gui_properties['SMOKE_COLOR']) / 255
 
-    glBegin(GL_LINES)
-    for i in range(1, N + 1):
-        x = (i - 0.5) * h
-        for j in range(1, N + 1):
-            y = (j - 0.5) * h
-            glColor3f(SMOKE_COLOR[0]/255, SMOKE_COLOR[1]/255, SMOKE_COLOR[2]/255)
-            glVertex2f(x, y)
-            glVertex2f(x + simulation_data['u'][i, j], y + simulation_data['v'][i, j])
-    glEnd()
 
+# cell-centred velocity over the whole (size,size) grid, averaged from the staggered faces like advect() does
+def cell_centred_velocity():
+    size = simulation_properties['size']
+    u, v = simulation_data['u'], simulation_data['v']
+    uc = 0.5 * (u[0:size,0:size] + u[1:size+1,0:size])
+    vc = 0.5 * (v[0:size,0:size] + v[0:size,1:size+1])
+    return uc, vc
 
-def draw_density():
 
+# one line per sampled cell from the cell centre along (u,v), returned as GL_LINES vertex and color arrays
+def glyph_segments(u=None, v=None, N=None):
+    if u is None:
+        u, v, N = simulation_data['u'], simulation_data['v'], simulation_properties['N']
+    h = 1.0 / N
+    stride = velocity_stride(N)
+    u = u[1:N+1:stride, 1:N+1:stride]
+    v = v[1:N+1:stride, 1:N+1:stride]
+    x = (np.arange(1, N + 1, stride) - 0.5) * h
+    n = len(x)
+
+    vertices = velocity_buffer('glyph_vertices', (n*n*2, 2))
+    lines = vertices.reshape(n, n, 2, 2) # [i, j, start/end, x/y]
+    lines[:, :, 0, 0] = x[:, np.newaxis]
+    lines[:, :, 0, 1] = x[np.newaxis, :]
+    lines[:, :, 1, 0] = lines[:, :, 0, 0] + u
+    lines[:, :, 1, 1] = lines[:, :, 0, 1] + v
+    colors = velocity_buffer('glyph_colors', (n*n*2, 3))
+    velocity_colors(colors.reshape(n, n, 2, 3), np.hypot(u, v)[:, :, np.newaxis])
+    return vertices, colors
+
+
+# streamlines seeded on the sampled cells, all traced at once with midpoint steps
+# each line covers up to two strides (at the fastest speed) so neighbouring lines just touch
+def streamline_segments():
     N = simulation_properties['N']
     h = 1.0 / N
+    stride = velocity_stride(N)
+    steps = gui_properties['STREAMLINE_STEPS']
+    uc, vc = cell_centred_velocity()
+    speed = np.hypot(uc, vc)
+    scale = 2.0 * stride / steps / max(speed[1:N+1,1:N+1].max(), 1e-12) # cells moved per step per unit of velocity
+
+    seeds = np.arange(1, N + 1, stride, dtype=np.float64)
+    x = np.repeat(seeds, len(seeds))
+    y = np.tile(seeds, len(seeds))
+    vertices = velocity_buffer('streamline_vertices', (steps, len(x), 2, 2))
+    colors = velocity_buffer('streamline_colors', (steps, len(x), 2, 3))
+    for k in range(steps):
+        vertices[k, :, 0, 0] = x
+        vertices[k, :, 0, 1] = y
+        seed_speed = interpolate(speed, x, y)
+        xm = np.clip(x + 0.5 * scale * interpolate(uc, x, y), 0.5, N + 0.5)
+        ym = np.clip(y + 0.5 * scale * interpolate(vc, x, y), 0.5, N + 0.5)
+        x = np.clip(x + scale * interpolate(uc, xm, ym), 0.5, N + 0.5)
+        y = np.clip(y + scale * interpolate(vc, xm, ym), 0.5, N + 0.5)
+        vertices[k, :, 1, 0] = x
+        vertices[k, :, 1, 1] = y
+        velocity_colors(colors[k], seed_speed[:, np.newaxis])
+    vertices -= 0.5 # cell coordinates to window coordinates
+    vertices *= h
+    return vertices.reshape(-1, 2), colors.reshape(-1, 3)
+
+
+# line integral convolution: white noise averaged along the flow through every cell, shown as a texture
+def draw_velocity_lic():
+    N = simulation_properties['N']
+    size = simulation_properties['size']
+    steps = gui_properties['LIC_STEPS']
+    uc, vc = cell_centred_velocity()
+    speed = np.hypot(uc, vc)
+    ux = uc / (speed + 1e-12) # unit direction, half a cell per sample
+    uy = vc / (speed + 1e-12)
+
+    noise = gui_properties['VELOCITY_BUFFERS'].get('lic_noise')
+    if noise is None or noise.shape != (size,size):
+        noise = np.random.default_rng(0).random((size,size))
+        gui_properties['VELOCITY_BUFFERS']['lic_noise'] = noise
+
+    cells = np.arange(1, N + 1, dtype=np.float64)
+    total = noise[1:N+1,1:N+1].copy()
+    for direction in (0.5, -0.5):
+        x = np.repeat(cells[:, np.newaxis], N, axis=1)
+        y = np.repeat(cells[np.newaxis, :], N, axis=0)
+        for k in range(steps):
+            dx = direction * interpolate(ux, x, y)
+            dy = direction * interpolate(uy, x, y)
+            x = np.clip(x + dx, 0.5, N + 0.5)
+            y = np.clip(y + dy, 0.5, N + 0.5)
+            total += interpolate(noise, x, y)
+    intensity = total / (2*steps + 1)
+    intensity = np.clip((intensity - 0.5) * 3 + 0.5, 0, 1) # averaging flattens the noise, stretch the contrast back
+
+    image = velocity_buffer('lic_image', (N, N, 3)) # indexed [y, x] as OpenGL expects
+    velocity_colors(image, speed[1:N+1,1:N+1].T)
+    image *= intensity.T[:, :, np.newaxis]
+
+    if gui_properties['LIC_TEXTURE'] is None:
+        gui_properties['LIC_TEXTURE'] = glGenTextures(1)
+    glEnable(GL_TEXTURE_2D)
+    glBindTexture(GL_TEXTURE_2D, gui_properties['LIC_TEXTURE'])
+    glTexParameteri(GL_TEXTURE_2D, GL_TEXTURE_MIN_FILTER, GL_LINEAR)
+    glTexParameteri(GL_TEXTURE_2D, GL_TEXTURE_MAG_FILTER, GL_LINEAR)
+    glTexImage2D(GL_TEXTURE_2D, 0, GL_RGB, N, N, 0, GL_RGB, GL_FLOAT, image)
+    glColor3f(1.0, 1.0, 1.0)
+    glBegin(GL_QUADS)
+    glTexCoord2f(0.0, 0.0)
+    glVertex2f(0.0, 0.0)
+    glTexCoord2f(1.0, 0.0)
+    glVertex2f(1.0, 0.0)
+    glTexCoord2f(1.0, 1.0)
+    glVertex2f(1.0, 1.0)
+    glTexCoord2f(0.0, 1.0)
+    glVertex2f(0.0, 1.0)
+    glEnd()
+    glDisable(GL_TEXTURE_2D)
+
+
+# draws the smoke, by default from simulation_data; the 3D solver passes the arrays of its z slice
+def draw_density(red=None, green=None, blue=None):
+
+    if red is None:
+        red, green, blue = simulation_data['red_dens'], simulation_data['green_dens'], simulation_data['blue_dens']
+    N = red.shape[0] - 2
+    h = 1.0 / N
     SMOKE_COLOR = gui_properties['SMOKE_COLOR']
 
     glBegin(GL_QUADS)
@@ -399,18 +716,18 @@ def draw_density():
         x = (i - 0.5) * h
         for j in range(0, N + 1):
             y = (j - 0.5) * h
-            d1_00 = min(simulation_data['red_dens'][i, j],1)
-            d1_01 = min(simulation_data['red_dens'][i, j + 1],1)
-            d1_10 = min(simulation_data['red_dens'][i + 1, j],1)
-            d1_11 = min(simulation_data['red_dens'][i + 1, j + 1],1)
-            d2_00 = min(simulation_data['green_dens'][i, j],1)
-            d2_01 = min(simulation_data['green_dens'][i, j + 1],1)
-            d2_10 = min(simulation_data['green_dens'][i + 1, j],1)
-            d2_11 = min(simulation_data['green_dens'][i + 1, j + 1],1)
-            d3_00 = min(simulation_data['blue_dens'][i, j],1)
-            d3_01 = min(simulation_data['blue_dens'][i, j + 1],1)
-            d3_10 = min(simulation_data['blue_dens'][i + 1, j],1)
-            d3_11 = min(simulation_data['blue_dens'][i + 1, j + 1],1)
+            d1_00 = min(red[i, j],1)
+            d1_01 = min(red[i, j + 1],1)
+            d1_10 = min(red[i + 1, j],1)
+            d1_11 = min(red[i + 1, j + 1],1)
+            d2_00 = min(green[i, j],1)
+            d2_01 = min(green[i, j + 1],1)
+            d2_10 = min(green[i + 1, j],1)
+            d2_11 = min(green[i + 1, j + 1],1)
+            d3_00 = min(blue[i, j],1)
+            d3_01 = min(blue[i, j + 1],1)
+            d3_10 = min(blue[i + 1, j],1)
+            d3_11 = min(blue[i + 1, j + 1],1)
 
             glColor3f(d1_00, d2_00, d3_00)
             glVertex2f(x, y)
@@ -423,6 +740,24 @@ def draw_density():
     glEnd()
 
 
+# draws solid obstacle cells as gray squares on top of the density or velocity display, as one vertex array
+def draw_obstacles():
+
+    N = simulation_properties['N']
+    h = 1.0 / N
+    i, j = np.nonzero(obstacle_properties['solid'])
+
+    vertices = velocity_buffer('obstacle_vertices', (len(i), 4, 2)) # [cell, corner, x/y]
+    vertices[:, 0, 0] = vertices[:, 3, 0] = (i - 1) * h
+    vertices[:, 1, 0] = vertices[:, 2, 0] = i * h
+    vertices[:, 0, 1] = vertices[:, 1, 1] = (j - 1) * h
+    vertices[:, 2, 1] = vertices[:, 3, 1] = j * h
+
+    glColor3f(0.4, 0.4, 0.4)
+    glEnableClientState(GL_VERTEX_ARRAY)
+    glVertexPointer(2, GL_FLOAT, 0, vertices)
+    glDrawArrays(GL_QUADS, 0, 4 * len(i))
+    glDisableClientState(GL_VERTEX_ARRAY)
 
 
 def get_from_UI():
@@ -440,9 +775,7 @@ def get_from_UI():
     if not gui_properties['MOUSE_DOWN'][GLUT_LEFT_BUTTON] and not gui_properties['MOUSE_DOWN'][GLUT_RIGHT_BUTTON]:
         return
 
-    i = int((gui_properties['MOUSE_X'] / float(gui_properties['SCREEN_WIDTH'])) * N + 1)
-    j = int(((gui_properties['SCREEN_HEIGHT'] - float(gui_properties['MOUSE_Y'])) / float(gui_properties['SCREEN_HEIGHT'])) * float(N) + 1.0)
-
+    i, j = mouse_cell(N)
     if i < 1 or i > N or j < 1 or j > N:
         return
 
@@ -462,6 +795,13 @@ def get_from_UI():
     gui_properties['ORIG_MOUSE_Y'] = gui_properties['MOUSE_Y']
 
 
+# the grid cell under the mouse for a grid of N x N cells (the result may be outside the grid)
+def mouse_cell(N):
+    i = int((gui_properties['MOUSE_X'] / float(gui_properties['SCREEN_WIDTH'])) * N + 1)
+    j = int(((gui_properties['SCREEN_HEIGHT'] - float(gui_properties['MOUSE_Y'])) / float(gui_properties['SCREEN_HEIGHT'])) * float(N) + 1.0)
+    return i, j
+
+
 def key_func(key, x, y):
 
     if key == b'c' or key == b'C':
@@ -478,6 +818,24 @@ def key_func(key, x, y):
         gui_properties['SMOKE_COLOR'] = (0,0,255)
     if key == b'w' or key == b'W':
         gui_properties['SMOKE_COLOR'] = (255,255,255)
+    if key == b'p' or key == b'P': # toggles between a closed box and a periodic (wrap-around) domain
+        if simulation_properties['boundary_modes']['left'] == 'periodic':
+            set_boundary_modes(left='wall', right='wall', bottom='wall', top='wall')
+        else:
+            set_boundary_modes(left='periodic', right='periodic', bottom='periodic', top='periodic')
+    if key == b'm' or key == b'M': # cycles through the velocity display modes
+        modes = ['glyphs', 'streamlines', 'lic']
+        gui_properties['VELOCITY_MODE'] = modes[(modes.index(gui_properties['VELOCITY_MODE']) + 1) % len(modes)]
+    if key == b'n' or key == b'N':
+        gui_properties['VELOCITY_COLOR_BY_MAGNITUDE'] = not gui_properties['VELOCITY_COLOR_BY_MAGNITUDE']
+    if key == b'[' or key == b']': # moves the displayed slice of the 3D volume
+        volume_properties['slice'] = min(max(volume_properties['slice'] + (1 if key == b']' else -1), 1), volume_properties['N'])
+    if key == b'f' or key == b'F': # toggles the FFT pressure/viscosity solver, which is used while the domain is periodic
+        simulation_properties['linear_solver_mode'] = 'relaxation' if simulation_properties['linear_solver_mode'] == 'spectral' else 'spectral'
+    if key == b'o' or key == b'O': # drops a circular obstacle under the mouse
+        add_obstacle_circle(x / float(gui_properties['SCREEN_WIDTH']), 1.0 - y / float(gui_properties['SCREEN_HEIGHT']), 0.05)
+    if (key == b'x' or key == b'X') and obstacle_properties['shapes']: # removes the most recently added obstacle
+        remove_obstacle(obstacle_properties['shapes'][-1])
 
 
 def mouse_func(button, state, x, y):
@@ -508,22 +866,40 @@ def idle_func():
     N, visc, dt, diff, menu = simulation_properties['N'], simulation_properties['visc'], simulation_properties['dt'], ['diff'], gui_properties['THORPY_ELEMENTS']['menu']
     simulation_properties['dt'] = gui_properties['CLOCK'].tick()/1000
 
-    get_from_UI()
+    if volume_properties['enabled']:
+        simulation_step3D()
+    else:
+        if replay_properties['recording']:
+            record_step_inputs()
+        simulation_step()
+        if replay_properties['recording']:
+            record_checkpoint()
 
+    glutPostRedisplay()
+    pygame_idle_function()
+
+# advances the simulation by one time step using the current inputs. Also used headlessly by replay()
+def simulation_step():
+
+    update_obstacles()
+    get_from_UI()
 
     dens_step()
     velocity_step()
-
-    glutPostRedisplay()
-    pygame_idle_function()
+    if diagnostics_properties['every']:
+        record_diagnostics()
 
 def display_func():
 
     pre_display()
-    if gui_properties['DISPLAY_VELOCITY']:
+    if volume_properties['enabled']:
+        draw_volume_slice()
+    elif gui_properties['DISPLAY_VELOCITY']:
         draw_velocity()
     else:
         draw_density()
+    if obstacle_properties['solid_count']:
+        draw_obstacles()
     post_display()
 
 def open_glut_window():
@@ -533,6 +909,10 @@ def open_glut_window():
     glutInitWindowPosition(80, 100)
     glutInitWindowSize(gui_properties['SCREEN_WIDTH'], gui_properties['SCREEN_HEIGHT'])
     glutCreateWindow("Fluid Solver with Staggered Grid")
+    # closing the window calls C exit() by default, which skips the atexit handlers that write the output files
+    # freeglut can return from glutMainLoop() instead, so main() gets to finish them
+    if bool(glutSetOption):
+        glutSetOption(GLUT_ACTION_ON_WINDOW_CLOSE, GLUT_ACTION_GLUTMAINLOOP_RETURNS)
     glClearColor(0.0, 0.0, 0.0, 1.0)
     glClear(GL_COLOR_BUFFER_BIT)
     glutSwapBuffers()
@@ -669,31 +1049,38 @@ def apply_buoyant_force():
 def advect(m,m0,u,v,b):
     N = simulation_properties['N']
     dt0 = simulation_properties['dt'] * N
-    for i in range(1, N + 1):
-        for j in range(1, N + 1):
-            x = i - dt0 * (u[i, j]+u[i+1,j])/2
-            y = j - dt0 * (v[i, j]+v[i,j+1])/2
-            if x < 0.5:
-                x = 0.5
-            if x > N + 0.5:
-                x = N + 0.5
-            i0 = int(x)
-            i1 = i0 + 1
-            if y < 0.5:
-                y = 0.5
-            if y > N + 0.5:
-                y = N + 0.5
-            j0 = int(y)
-            j1 = j0 + 1
-            s1 = x - i0
-            s0 = 1 - s1
-            t1 = y - j0
-            t0 = 1 - t1
-            m[i, j] = (s0 * (t0 * m0[i0, j0] + t1 * m0[i0, j1]) + s1 *
-                       (t0 * m0[i1, j0] + t1 * m0[i1, j1]))
+    i = np.arange(1, N + 1)[:, np.newaxis] # column of i indices, broadcast against rows of j indices
+    j = np.arange(1, N + 1)[np.newaxis, :]
+    x = i - dt0 * (u[1:N+1,1:N+1]+u[2:N+2,1:N+1])/2
+    y = j - dt0 * (v[1:N+1,1:N+1]+v[1:N+1,2:N+2])/2
+    # periodic dimensions wrap the backtrace around instead of clamping it to the box
+    if simulation_properties['boundary_modes']['left'] == 'periodic':
+        x = (x - 0.5) % N + 0.5
+    else:
+        np.clip(x, 0.5, N + 0.5, out=x)
+    if simulation_properties['boundary_modes']['bottom'] == 'periodic':
+        y = (y - 0.5) % N + 0.5
+    else:
+        np.clip(y, 0.5, N + 0.5, out=y)
+    m[1:N+1,1:N+1] = interpolate(m0,x,y)
     set_bnd(b,m)
 
 
+# bilinear interpolation of m0 at the fractional grid positions given by the arrays x and y
+# x and y must already be clamped so that the four surrounding grid points are inside m0
+def interpolate(m0,x,y):
+    i0 = x.astype(np.intp)
+    i1 = i0 + 1
+    j0 = y.astype(np.intp)
+    j1 = j0 + 1
+    s1 = x - i0
+    s0 = 1 - s1
+    t1 = y - j0
+    t0 = 1 - t1
+    return (s0 * (t0 * m0[i0, j0] + t1 * m0[i0, j1]) + s1 *
+            (t0 * m0[i1, j0] + t1 * m0[i1, j1]))
+
+
 
 def project():
     # the u_prev and v_prev are unneeded at the time of project() and are used as
@@ -702,18 +1089,32 @@ def project():
     div = simulation_data['v_prev']
     N = simulation_properties['N']
     h = 1.0 / N # inter-grid spacing
-    div[1:N+2,1:N+2] = (-0.5 * h *
-                       (simulation_data['u'][2:N + 3, 1:N + 2] - simulation_data['u'][0:N+1, 1:N + 2] +
-                        simulation_data['v'][1:N + 2, 2:N + 3] - simulation_data['v'][1:N + 2, 0:N+1]))  #divergence
+    compute_divergence(div)
+    if obstacle_properties['solid_count']:
+        div[0:N+2,0:N+2] *= obstacle_properties['fluid'] # no divergence to correct inside solid obstacles
     p[1:N+2,1:N+2] = 0 # divergence-free
     set_bnd(0,div)
-    set_bnd(0,p)
-    lin_solve(p,div,1,4,b=0)
+    set_bnd(3,p)
+    lin_solve(p,div,1,4,b=3) # b==3 is the pressure, which only differs from b==0 on open edges
     simulation_data['u'][1:N+1,1:N+1] -= 0.5 * (p[2:N+2,1:N+1] - p[0:N,1:N+1]) / h
     simulation_data['v'][1:N+1,1:N+1] -= 0.5 * (p[1:N+1,2:N+2] - p[1:N+1,0:N]) / h
+    # on periodic edges the last face is the first one again, which the gradient above has just updated
+    if simulation_properties['boundary_modes']['left'] == 'periodic':
+        simulation_data['u'][N+1,1:N+1] = simulation_data['u'][1,1:N+1]
+    if simulation_properties['boundary_modes']['bottom'] == 'periodic':
+        simulation_data['v'][1:N+1,N+1] = simulation_data['v'][1:N+1,1]
     for i,char in enumerate(['u','v']):
         set_bnd(i+1,simulation_data[char],vd=char)
 
+
+# writes the divergence of the current velocity (scaled as the right hand side of the pressure solve) into div[1:N+2,1:N+2]
+def compute_divergence(div):
+    N = simulation_properties['N']
+    h = 1.0 / N
+    div[1:N+2,1:N+2] = (-0.5 * h *
+                       (simulation_data['u'][2:N + 3, 1:N + 2] - simulation_data['u'][0:N+1, 1:N + 2] +
+                        simulation_data['v'][1:N + 2, 2:N + 3] - simulation_data['v'][1:N + 2, 0:N+1]))
+
 # adds velocity in one dimension
 # presumably this is used twice (x- and y-)
 # m is the u- or v- velocities in the simulation_data
@@ -746,6 +1147,9 @@ def lin_solve(m, m0, a, c, b=None, vd=None):
         b = 1
     elif vd == 'v':
         b = 2
+    if vd is None and use_spectral_solver():
+        spectral_solve(m, m0, a, c, b)
+        return
     for k in range(0, kf):
         m[1:N+1+(vd=='u'),1:N+1+(vd=='v')] = (m0[1:N+1+(vd=='u'),1:N+1+(vd=='v')] + a *
                                               (m[0:N+(vd=='u'),1:N+1+(vd=='v')] +
@@ -758,71 +1162,1272 @@ def lin_solve(m, m0, a, c, b=None, vd=None):
     # for velocitiy because the dimension is specified
 
 
+# the spectral solver needs a fully periodic domain without obstacles, otherwise lin_solve() falls back to relaxation
+def use_spectral_solver():
+    modes = simulation_properties['boundary_modes']
+    return (simulation_properties['linear_solver_mode'] == 'spectral' and modes['left'] == 'periodic' and
+            modes['bottom'] == 'periodic' and not obstacle_properties['solid_count'])
 
-# sets the boundaries of the simulation
+
+# returns the cached Laplacian eigenvalues and the inverse symbol of the pressure operator for the current N,
+# laid out like the output of numpy.fft.rfft2
+# project() takes the divergence and the pressure gradient with central differences over 2h, so the operator it
+# has to invert is (4p - p[i+2] - p[i-2] - p[j+2] - p[j-2])/4, not the 5-point Laplacian. Its symbol
+# sin^2(kx) + sin^2(ky) vanishes on the mean and on the Nyquist (checkerboard) modes, which the gradient can't see
+def laplacian_eigenvalues():
+    N = simulation_properties['N']
+    if spectral_properties['N'] != N:
+        kx = 2 * np.pi * np.fft.fftfreq(N)[:, np.newaxis]
+        ky = 2 * np.pi * np.fft.rfftfreq(N)[np.newaxis, :]
+        eigenvalues = 4 - 2 * np.cos(kx) - 2 * np.cos(ky)
+        symbol = np.sin(kx)**2 + np.sin(ky)**2
+        null = (np.absolute(np.sin(kx)) < 1e-9) & (np.absolute(np.sin(ky)) < 1e-9) # kx and ky both 0 or pi
+        pressure_inverse = np.zeros_like(symbol)
+        pressure_inverse[~null] = 1.0 / symbol[~null]
+        spectral_properties['eigenvalues'] = eigenvalues
+        spectral_properties['pressure_inverse'] = pressure_inverse
+        spectral_properties['N'] = N
+    return spectral_properties['eigenvalues'], spectral_properties['pressure_inverse']
+
+
+# exact solution of the system relaxed by lin_solve(), c*m - a*(sum of the 4 neighbours of m) = m0,
+# on the periodic N x N interior. Diagonalised by the FFT, so it costs O(N^2 log N) whatever the coefficients
+# For the pressure (b == 3) it solves the system project() actually needs instead, see laplacian_eigenvalues(),
+# which leaves the velocity exactly divergence-free as project() measures it
+def spectral_solve(m, m0, a, c, b):
+    N = simulation_properties['N']
+    if a == 0:
+        m[1:N+1,1:N+1] = m0[1:N+1,1:N+1] / c
+    else:
+        eigenvalues, pressure_inverse = laplacian_eigenvalues()
+        m_hat = np.fft.rfft2(m0[1:N+1,1:N+1])
+        if b == 3: # the pressure, whose mean (and checkerboard modes) are set to zero
+            m_hat *= pressure_inverse / a
+        else: # diffusion: 1 + a*eigenvalue is never zero
+            m_hat /= c - 4 * a + a * eigenvalues
+        m[1:N+1,1:N+1] = np.fft.irfft2(m_hat, s=(N,N))
+    set_bnd(b,m)
+
+
+
+# sets the boundaries of the simulation according to simulation_properties['boundary_modes']
 # slightly different calculations occur for velocity matrices
 # depending on the dimension (u- or v-) because of the mismatched sizes in the
 # staggered grid
+# b is 0 for smoke/temperature, 1 for u, 2 for v and 3 for pressure
 # TODO: del this line           for i,char in enumerate(['u']):
         #set_bnd(i+1,simulation_data[char],vd=char)
 def set_bnd(b,m,vd=None):
     N = simulation_properties['N']
+    modes = simulation_properties['boundary_modes']
+    du = int(vd=='u') # the staggered grids have an extra face along their own dimension
+    dv = int(vd=='v')
+    rows = slice(1, N + 1 + dv) # interior rows of the left and right edges
+    cols = slice(1, N + 1 + du) # interior columns of the bottom and top edges
 
     # setting bounds on edges
     # note that velocity grids are still square-shaped, so this routine ends up doing
     # calculations on a unused extraneous row of data for velocity-grids as an ease-of-programming trade-off
-    for i in range(1, N + 1 + 0):
-        if b == 1:
-            m[0, i] = -m[1, i]
+    if modes['left'] == 'periodic':
+        if du:
+            m[1, rows] = m[N + 1, rows] = 0.5 * (m[1, rows] + m[N + 1, rows]) # faces 1 and N+1 are the same face
+        m[0, rows] = m[N, rows]
+        m[N + 1 + du, rows] = m[1 + du, rows]
+    else:
+        m[0, rows] = edge_ghost(b, 1, 'left', m[1, rows])
+        m[N + 1 + du, rows] = edge_ghost(b, 1, 'right', m[N + du, rows])
+        # faces 1 and N+1 of the u grid lie on the edges and are unknowns, not ghosts, so inflow prescribes them directly
+        if b == 1 and modes['left'] == 'inflow':
+            m[1, rows] = simulation_properties['inflow_velocity']['left'][0]
+        if b == 1 and modes['right'] == 'inflow':
+            m[N + 1, rows] = simulation_properties['inflow_velocity']['right'][0]
+
+    if modes['bottom'] == 'periodic':
+        if dv:
+            m[cols, 1] = m[cols, N + 1] = 0.5 * (m[cols, 1] + m[cols, N + 1])
+        m[cols, 0] = m[cols, N]
+        m[cols, N + 1 + dv] = m[cols, 1 + dv]
+    else:
+        m[cols, 0] = edge_ghost(b, 2, 'bottom', m[cols, 1])
+        m[cols, N + 1 + dv] = edge_ghost(b, 2, 'top', m[cols, N + dv])
+        if b == 2 and modes['bottom'] == 'inflow':
+            m[cols, 1] = simulation_properties['inflow_velocity']['bottom'][1]
+        if b == 2 and modes['top'] == 'inflow':
+            m[cols, N + 1] = simulation_properties['inflow_velocity']['top'][1]
+
+    # setting bounds on corners
+    # a periodic dimension wraps the ghost values of the other dimension, otherwise the corners are averaged
+    corners_x = [0, N + 1 + du]
+    corners_y = [0, N + 1 + dv]
+    if modes['left'] == 'periodic':
+        m[0, corners_y] = m[N, corners_y]
+        m[N + 1 + du, corners_y] = m[1 + du, corners_y]
+    elif modes['bottom'] == 'periodic':
+        m[corners_x, 0] = m[corners_x, N]
+        m[corners_x, N + 1 + dv] = m[corners_x, 1 + dv]
+    else:
+        m[0, 0] = 0.5 * (m[1, 0] + m[0, 1])
+        m[0, N + 1 + dv] = 0.5 * (m[1, N + 1 + dv] + m[0, N + dv])
+        m[N + 1 + du, 0] = 0.5 * (m[N + du, 0] + m[N + 1 + du, 1])
+        m[N + 1 + du, N + 1 + dv] = 0.5 * (m[N + du, N + 1 + dv] + m[N + 1 + du, N + dv])
+
+    if obstacle_properties['solid_count']:
+        set_obstacle_bnd(b,m)
+
+
+# returns the ghost values of a non-periodic edge from the adjacent interior values
+# normal_b is the b code of the velocity component crossing the edge (1 for left/right, 2 for bottom/top)
+def edge_ghost(b, normal_b, edge, inner):
+    mode = simulation_properties['boundary_modes'][edge]
+    if mode == 'outflow':
+        # zero pressure on the edge lets fluid leave, everything else just flows out with zero gradient
+        return -inner if b == 3 else inner
+    if mode == 'inflow' and b == normal_b:
+        return simulation_properties['inflow_velocity'][edge][b-1] # set_bnd() also sets the face on the edge
+    if mode == 'inflow' and b in (1,2):
+        return 2*simulation_properties['inflow_velocity'][edge][b-1] - inner # the tangential velocity midway to the ghost is prescribed
+    if mode == 'inflow' and b == 0:
+        return 0.0 # clean fluid comes in
+    # reflective wall (and the pressure on inflow edges)
+    return -inner if b == normal_b else inner
+
+
+# changes the boundary mode of one or more edges, e.g. set_boundary_modes(left='inflow', right='outflow')
+def set_boundary_modes(left=None, right=None, bottom=None, top=None):
+    modes = dict(simulation_properties['boundary_modes'])
+    for edge,mode in [('left',left),('right',right),('bottom',bottom),('top',top)]:
+        if mode is None:
+            continue
+        if mode not in ('wall','periodic','inflow','outflow'):
+            raise ValueError('unknown boundary mode ' + repr(mode))
+        modes[edge] = mode
+    if (modes['left'] == 'periodic') != (modes['right'] == 'periodic') or (modes['bottom'] == 'periodic') != (modes['top'] == 'periodic'):
+        raise ValueError('periodic boundaries must be set on opposite edges together')
+    simulation_properties['boundary_modes'] = modes
+
+
+#####################
+# obstacles
+# every obstacle is rasterised into one boolean mask of solid cells, and the cells and faces touching the obstacles are
+# listed in index arrays that set_obstacle_bnd() applies the boundary conditions through. When a shape is added,
+# removed or moves to other cells, only the window around its old and new footprints is recomputed, see rebuild_obstacles()
+#####################
+
+# loads a static obstacle mask from an image file (dark pixels are solid) or from an array indexed [x,y] (nonzero is solid)
+# the mask can have any resolution, it is resampled onto the simulation grid
+def load_obstacle_mask(source):
+    if isinstance(source, str):
+        pixels = pygame.surfarray.array3d(pygame.image.load(source)).mean(axis=2) # indexed [x,y] with y pointing down
+        mask = pixels[:, ::-1] < 127.5 # flip so y points up like the simulation grid
+    else:
+        mask = np.asarray(source) != 0
+    obstacle_properties['static_source'] = mask
+    obstacle_properties['dirty'] = True
+
+
+# adds a moving rectangle centred on (x,y); positions, sizes and velocities are in window units (the grid spans [0,1])
+def add_obstacle_rect(x, y, width, height, vx=0.0, vy=0.0):
+    return add_obstacle({'type':'rect','x':x,'y':y,'width':width,'height':height,'vx':vx,'vy':vy,'footprint':None})
+
+
+# adds a moving circle centred on (x,y), same units as add_obstacle_rect()
+def add_obstacle_circle(x, y, radius, vx=0.0, vy=0.0):
+    return add_obstacle({'type':'circle','x':x,'y':y,'radius':radius,'vx':vx,'vy':vy,'footprint':None})
+
+
+def add_obstacle(shape):
+    record_event('add_obstacle', shape=recorded_shape(shape))
+    obstacle_properties['shapes'].append(shape)
+    if not obstacle_properties['dirty']:
+        shape['footprint'] = rasterise_obstacle(shape)
+        rebuild_obstacles(*footprint_box(shape['footprint']))
+    return shape
+
+
+def remove_obstacle(shape):
+    index = [id(other) for other in obstacle_properties['shapes']].index(id(shape)) # footprints can't be compared with ==
+    record_event('remove_obstacle', index=index)
+    del obstacle_properties['shapes'][index]
+    if not obstacle_properties['dirty'] and shape['footprint'] is not None:
+        rebuild_obstacles(*footprint_box(shape['footprint']))
+
+
+def clear_obstacles():
+    obstacle_properties['static_source'] = None
+    obstacle_properties['shapes'] = []
+    obstacle_properties['dirty'] = True
+    build_obstacle_index()
+
+
+# returns the footprint of a shape as (i0, j0, mask), where mask covers the cells [i0,i0+width) x [j0,j0+height)
+# of its bounding box and is True in the cells whose centres are inside the shape
+def rasterise_obstacle(shape):
+    N = simulation_properties['N']
+    if shape['type'] == 'rect':
+        half_x, half_y = 0.5*shape['width'], 0.5*shape['height']
+    else:
+        half_x = half_y = shape['radius']
+    i0 = min(max(int(np.floor((shape['x'] - half_x) * N)), 1), N + 1)
+    i1 = min(max(int(np.floor((shape['x'] + half_x) * N)) + 2, i0), N + 1)
+    j0 = min(max(int(np.floor((shape['y'] - half_y) * N)), 1), N + 1)
+    j1 = min(max(int(np.floor((shape['y'] + half_y) * N)) + 2, j0), N + 1)
+    x = ((np.arange(i0, i1) - 0.5) / N)[:, np.newaxis]
+    y = ((np.arange(j0, j1) - 0.5) / N)[np.newaxis, :]
+    if shape['type'] == 'rect':
+        return i0, j0, (np.absolute(x - shape['x']) <= half_x) & (np.absolute(y - shape['y']) <= half_y)
+    return i0, j0, (x - shape['x'])**2 + (y - shape['y'])**2 <= shape['radius']**2
+
+
+# the window of cells (i0, i1, j0, j1) covering all of the given footprints, None entries are skipped
+def footprint_box(*footprints):
+    boxes = [(i0, i0 + mask.shape[0], j0, j0 + mask.shape[1]) for i0, j0, mask in filter(None, footprints)]
+    if not boxes:
+        return 1, 1, 1, 1
+    return min(b[0] for b in boxes), max(b[1] for b in boxes), min(b[2] for b in boxes), max(b[3] for b in boxes)
+
+
+# moves the obstacle shapes by one time step and recomputes the cells around every shape whose footprint changed
+# shapes bounce off the edges of the window
+def update_obstacles():
+    dt = simulation_properties['dt']
+    for shape in obstacle_properties['shapes']:
+        if not (shape['vx'] or shape['vy']):
+            continue
+        shape['x'] += dt*shape['vx']
+        shape['y'] += dt*shape['vy']
+        bounced = False
+        for pos,vel in [('x','vx'),('y','vy')]:
+            if (shape[pos] < 0.0 and shape[vel] < 0.0) or (shape[pos] > 1.0 and shape[vel] > 0.0):
+                shape[vel] = -shape[vel]
+                bounced = True # the obstacle velocity stored in the index arrays changed
+        previous = shape['footprint']
+        shape['footprint'] = rasterise_obstacle(shape)
+        if obstacle_properties['dirty'] or previous is None:
+            continue
+        if bounced or previous[:2] != shape['footprint'][:2] or not np.array_equal(previous[2], shape['footprint'][2]):
+            rebuild_obstacles(*footprint_box(previous, shape['footprint']))
+    if obstacle_properties['dirty']:
+        build_obstacle_index()
+
+
+# rebuilds the solid mask and the index arrays for the whole grid, after a new static mask or a change of N
+def build_obstacle_index():
+    N = simulation_properties['N']
+    size = simulation_properties['size']
+    static = np.zeros(shape=(size,size), dtype=bool)
+    source = obstacle_properties['static_source']
+    if source is not None:
+        x = (np.arange(N) * source.shape[0]) // N # nearest-neighbour resampling
+        y = (np.arange(N) * source.shape[1]) // N
+        static[1:N+1,1:N+1] = source[x[:, np.newaxis], y[np.newaxis, :]]
+    obstacle_properties['static'] = static
+    obstacle_properties['solid'] = np.zeros(shape=(size,size), dtype=bool)
+    obstacle_properties['fluid'] = np.ones(shape=(size,size), dtype=(np.float64))
+    obstacle_properties['velocity'] = np.zeros(shape=(2,size,size), dtype=(np.float64))
+    obstacle_properties['solid_count'] = 0
+    obstacle_properties['index'] = {'cell':None, 'u':None, 'v':None}
+    for shape in obstacle_properties['shapes']:
+        shape['footprint'] = rasterise_obstacle(shape)
+    obstacle_properties['dirty'] = False
+    rebuild_obstacles(1, N + 1, 1, N + 1)
+
+
+# recomputes the solid mask in the window of cells [i0,i1) x [j0,j1) from the static mask and the shape footprints,
+# then the index entries of the cells and faces whose boundary conditions depend on the cells in the window
+def rebuild_obstacles(i0, i1, j0, j1):
+    if i0 >= i1 or j0 >= j1:
+        return
+    N = simulation_properties['N']
+    size = simulation_properties['size']
+    solid = obstacle_properties['solid']
+    velocity = obstacle_properties['velocity'] # velocity of the obstacle in each solid cell
+    window = (slice(i0,i1), slice(j0,j1))
+    before = np.count_nonzero(solid[window])
+    solid[window] = obstacle_properties['static'][window]
+    velocity[:, i0:i1, j0:j1] = 0.0
+    for shape in obstacle_properties['shapes']: # later shapes paint over earlier ones
+        si, sj, mask = shape['footprint']
+        a0, a1 = max(i0, si), min(i1, si + mask.shape[0])
+        b0, b1 = max(j0, sj), min(j1, sj + mask.shape[1])
+        if a0 >= a1 or b0 >= b1:
+            continue
+        part = mask[a0-si:a1-si, b0-sj:b1-sj]
+        solid[a0:a1,b0:b1] |= part
+        velocity[0, a0:a1, b0:b1][part] = shape['vx']
+        velocity[1, a0:a1, b0:b1][part] = shape['vy']
+    obstacle_properties['fluid'][window] = ~solid[window]
+    obstacle_properties['solid_count'] += np.count_nonzero(solid[window]) - before
+
+    # a cell's condition depends on its four neighbours, a face's on the cells on both sides and the faces above and below
+    index = obstacle_properties['index']
+    cells = (max(i0-1,1), min(i1+1,N+1), max(j0-1,1), min(j1+1,N+1))
+    index['cell'] = merge_obstacle_index(index['cell'], cell_obstacle_index(solid, *cells), *cells)
+    faces = (i0, i1+1, max(j0-1,0), min(j1+1,size+1))
+    index['u'] = merge_obstacle_index(index['u'], face_obstacle_index(solid, velocity[0], *faces), *faces)
+    faces = (j0, j1+1, max(i0-1,0), min(i1+1,size+1)) # v faces are u faces of the transposed grid
+    index['v'] = merge_obstacle_index(index['v'], face_obstacle_index(solid.T, velocity[1].T, *faces), *faces)
+
+
+# replaces the entries of an index (a dict of groups, each holding its grid positions in 'at' and per-entry arrays
+# along their last axis) that lie in the window [i0,i1) x [j0,j1) with the entries computed for that window
+def merge_obstacle_index(index, window_index, i0, i1, j0, j1):
+    if index is None:
+        return window_index
+    merged = {}
+    for name, group in window_index.items():
+        at = index[name]['at']
+        keep = ~((at[0] >= i0) & (at[0] < i1) & (at[1] >= j0) & (at[1] < j1))
+        merged[name] = {key:np.concatenate([index[name][key][..., keep], group[key]], axis=-1) for key in group}
+    return merged
+
+
+# index entries for the cell-centred fields (smoke, temperature, pressure) in the window [i0,i1) x [j0,j1)
+# solid cells next to fluid copy the mean of their fluid neighbours (no flux through the obstacle surface),
+# solid cells buried inside an obstacle are zeroed. The ghost cells outside the box don't count as fluid neighbours,
+# they only mirror the inside, so an obstacle touching the box would otherwise feed on its own values
+def cell_obstacle_index(solid, i0, i1, j0, j1):
+    N = solid.shape[0] - 2
+    i, j = np.nonzero(solid[i0:i1,j0:j1])
+    i += i0
+    j += j0
+    neighbours = np.stack([np.stack([i-1, i+1, i, i]), np.stack([j, j, j-1, j+1])])
+    inside = (neighbours >= 1).all(axis=0) & (neighbours <= N).all(axis=0)
+    weights = (~solid[neighbours[0], neighbours[1]] & inside).astype(np.float64)
+    count = weights.sum(axis=0)
+    edge = count > 0
+    return {'inner':{'at':np.stack([i[~edge], j[~edge]])},
+            'edge':{'at':np.stack([i[edge], j[edge]]),
+                    'neighbours':neighbours[:, :, edge],
+                    'weights':weights[:, edge] / count[edge]}}
+
+
+# index entries for the faces [i0,i1) x [j0,j1) of the staggered u grid (pass transposed arrays for the v grid)
+# face i of row j lies between cells i-1 and i. Faces touching a solid cell get the obstacle velocity,
+# which stops flow through the obstacle. Faces buried inside the obstacle next to open faces above or below act
+# as ghost values for the tangential condition: they mirror the open faces for free slip and reflect them around
+# the obstacle velocity for no slip. Only the rows 1..N inside the box count as open, the ghost rows just mirror them
+def face_obstacle_index(solid, obstacle_velocity, i0, i1, j0, j1):
+    size = solid.shape[0]
+    ja, jb = max(j0-1, 0), min(j1+1, size+1) # one more row on each side to find the open faces above and below
+    fa, fb = max(i0, 1), min(i1, size) # faces with a cell on both sides
+    rb = min(jb, size)
+    left = np.zeros(shape=(i1-i0, jb-ja), dtype=bool)
+    right = np.zeros(shape=(i1-i0, jb-ja), dtype=bool)
+    left_velocity = np.zeros(shape=(i1-i0, jb-ja), dtype=(np.float64))
+    right_velocity = np.zeros(shape=(i1-i0, jb-ja), dtype=(np.float64))
+    if fa < fb and ja < rb:
+        inside = (slice(fa-i0, fb-i0), slice(0, rb-ja))
+        left[inside] = solid[fa-1:fb-1,ja:rb]
+        right[inside] = solid[fa:fb,ja:rb]
+        left_velocity[inside] = obstacle_velocity[fa-1:fb-1,ja:rb]
+        right_velocity[inside] = obstacle_velocity[fa:fb,ja:rb]
+
+    touching = left | right
+    target = (left*left_velocity + right*right_velocity) / np.maximum(left*1.0 + right, 1.0)
+    rows_inside = np.arange(ja, jb)[np.newaxis, :]
+    open_faces = ~touching & (rows_inside >= 1) & (rows_inside <= size - 2)
+    open_above = np.zeros_like(touching)
+    open_above[:,:-1] = open_faces[:,1:]
+    open_below = np.zeros_like(touching)
+    open_below[:,1:] = open_faces[:,:-1]
+    ghost = left & right & (open_above | open_below)
+
+    rows = (slice(None), slice(j0-ja, j1-ja)) # back from the extended rows to the window
+    touching, target, ghost, open_above, open_below = touching[rows], target[rows], ghost[rows], open_above[rows], open_below[rows]
+    ti, tj = np.nonzero(touching)
+    gi, gj = np.nonzero(ghost)
+    weights = np.stack([open_above[ghost], open_below[ghost]]).astype(np.float64)
+    ti += i0
+    tj += j0
+    gi += i0
+    gj += j0
+    return {'normal':{'at':np.stack([ti, tj]), 'value':target[touching]},
+            'ghost':{'at':np.stack([gi, gj]),
+                     'value':target[ghost],
+                     'neighbours':np.stack([np.stack([gi, gi]), np.stack([gj+1, gj-1])]),
+                     'weights':weights / weights.sum(axis=0)}}
+
+
+# applies the obstacle boundary conditions, called at the end of set_bnd()
+# b is the same code as in set_bnd(); velocity grids are recognised by their (size+1,size+1) shape
+def set_obstacle_bnd(b,m):
+    index = obstacle_properties['index']
+    if m.shape[0] == simulation_properties['size'] + 1 and b in (1,2):
+        face = index['u'] if b == 1 else index['v']
+        if b == 2:
+            m = m.T # view, so the assignments below still write into the v grid
+        m[tuple(face['normal']['at'])] = face['normal']['value']
+        ghost = face['ghost']
+        tangential = (ghost['weights'] * m[tuple(ghost['neighbours'])]).sum(axis=0)
+        if obstacle_properties['slip'] == 'no':
+            m[tuple(ghost['at'])] = 2*ghost['value'] - tangential
         else:
-            m[0, i] = m[1, i]
-        if b == 1:
-            m[N + 1 + (vd=='u'), i] = -m[N + (vd=='u'), i]
+            m[tuple(ghost['at'])] = tangential
+    else:
+        cell = index['cell']
+        m[tuple(cell['inner']['at'])] = 0.0
+        edge = cell['edge']
+        m[tuple(edge['at'])] = (edge['weights'] * m[tuple(edge['neighbours'])]).sum(axis=0)
+
+#####################
+# diagnostics
+# cheap statistics computed from the existing fields after each step (or every n-th step), kept in a ring buffer
+# that can be exported as CSV or JSON lines, or streamed as JSON lines to monitors connected to a local socket
+#####################
+
+# returns a scratch array for the diagnostics, reallocated only when the grid size changes
+def diagnostics_buffer(name, shape):
+    buffers = diagnostics_properties['buffers']
+    if name not in buffers or buffers[name].shape != shape:
+        buffers[name] = np.zeros(shape=shape, dtype=(np.float64))
+    return buffers[name]
+
+
+# computes the statistics of the current step, adds them to the ring buffer and sends them to connected monitors
+# called after velocity_step(), so the divergence is the one left by the final project()
+def record_diagnostics():
+    diagnostics_properties['step'] += 1
+    if diagnostics_properties['step'] % diagnostics_properties['every']:
+        return
+    N = simulation_properties['N']
+    h = 1.0 / N
+    dt = simulation_properties['dt']
+    u, v = simulation_data['u'], simulation_data['v']
+
+    # cell-centred velocity, averaged from the staggered faces like advect() does
+    uc = diagnostics_buffer('uc', (N,N))
+    vc = diagnostics_buffer('vc', (N,N))
+    speed = diagnostics_buffer('speed', (N,N))
+    np.add(u[1:N+1,1:N+1], u[2:N+2,1:N+1], out=uc)
+    uc *= 0.5
+    np.add(v[1:N+1,1:N+1], v[1:N+1,2:N+2], out=vc)
+    vc *= 0.5
+    np.hypot(uc, vc, out=speed)
+    max_velocity = speed.max()
+
+    div = diagnostics_buffer('div', (N+2,N+2))
+    compute_divergence(div)
+    div /= -h*h # compute_divergence() returns -h^2 times the divergence
+    if obstacle_properties['solid_count']:
+        div *= obstacle_properties['fluid']
+    div_interior = div[1:N+1,1:N+1]
+
+    curl = curl2D(u,v)[1:N+1,1:N+1]
+    temp = simulation_data['temp'][1:N+1,1:N+1]
+    record = {'step':diagnostics_properties['step'],
+              'time':time.time(),
+              'dt':dt,
+              'mass_red':h*h*simulation_data['red_dens'][1:N+1,1:N+1].sum(),
+              'mass_green':h*h*simulation_data['green_dens'][1:N+1,1:N+1].sum(),
+              'mass_blue':h*h*simulation_data['blue_dens'][1:N+1,1:N+1].sum(),
+              'kinetic_energy':0.5*h*h*np.vdot(speed,speed),
+              'max_velocity':max_velocity,
+              'cfl':max_velocity*dt*N, # largest backtrace in advect(), in cells
+              'divergence_rms':np.sqrt(np.vdot(div_interior,div_interior)/(N*N)),
+              'divergence_max':np.absolute(div_interior).max(),
+              'enstrophy':0.5*h*h*np.vdot(curl,curl),
+              'temp_min':temp.min(),
+              'temp_max':temp.max()}
+    for key in record:
+        if key != 'step':
+            record[key] = float(record[key]) # plain floats for the csv and json writers
+    record['blowup'] = not all(np.isfinite(value) for value in record.values()) or record['cfl'] > diagnostics_properties['cfl_limit']
+    if record['blowup'] and not diagnostics_properties['warned']:
+        print('WARNING: possible solver blow-up at step %d (CFL %.3g)' % (record['step'], record['cfl']))
+        diagnostics_properties['warned'] = True
+
+    diagnostics_properties['records'].append(record)
+    if diagnostics_properties['server'] is not None:
+        publish_diagnostics(record)
+
+
+# writes the ring buffer to a CSV file (for a .csv path) or a JSON lines file (anything else)
+def export_diagnostics(path):
+    records = list(diagnostics_properties['records'])
+    with open(path, 'w', newline='') as f:
+        if path.endswith('.csv'):
+            if records:
+                writer = csv.DictWriter(f, fieldnames=list(records[0].keys()))
+                writer.writeheader()
+                writer.writerows(records)
         else:
-            m[N + 1 + (vd=='u'), i] = m[N + (vd=='u'), i]
-        if b == 2:
-            m[i, 0] = -m[i, 1]
+            for record in records:
+                f.write(json.dumps(record) + '\n')
+
+
+# opens a non-blocking listening socket; monitors that connect get the ring buffer and then one JSON line per record
+def start_diagnostics_server(port, host='127.0.0.1'):
+    server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    server.bind((host, port))
+    server.listen()
+    server.setblocking(False)
+    diagnostics_properties['server'] = server
+
+
+# accepts waiting monitors and sends them the new record
+# the simulation never waits on a monitor: one that cannot keep up (or has gone away) is dropped
+def publish_diagnostics(record):
+    clients = diagnostics_properties['clients']
+    while True:
+        try:
+            client = diagnostics_properties['server'].accept()[0]
+        except BlockingIOError:
+            break
+        client.setblocking(False)
+        backlog = list(diagnostics_properties['records'])[:-1] # the new record is sent below
+        try:
+            client.sendall(''.join(json.dumps(old) + '\n' for old in backlog).encode())
+            clients.append(client)
+        except OSError:
+            client.close()
+    line = (json.dumps(record) + '\n').encode()
+    for client in list(clients):
+        try:
+            client.sendall(line)
+        except OSError:
+            client.close()
+            clients.remove(client)
+
+
+# writes the diagnostics file if one was requested, once. Called when glutMainLoop() returns and registered with atexit
+# for the other ways out (Esc, closing the toolbox)
+def finish_diagnostics():
+    if diagnostics_properties['output']:
+        export_diagnostics(diagnostics_properties['output'])
+        diagnostics_properties['output'] = None
+
+
+#####################
+# record and replay
+# a recording is a JSON lines file (NAME.jsonl) and a NumPy archive (NAME.npz). The first line holds the simulation
+# properties and obstacles; then every step gets a line with its dt, the GUI inputs and properties that changed and the
+# events (clearing the fields, adding or removing obstacles) since the last step, and every checkpoint_every steps a line
+# with the hashes of the fields. The archive holds the fields at the start and the golden snapshots of the fields at
+# every checkpoint. Both files are written as the session goes, so a recording of any length only keeps one step in memory,
+# but the archive is only complete once stop_recording() has closed it
+#####################
+
+# returns the entries of values that differ from the ones seen last time, and remembers them
+# values are compared through JSON so that tuples and the lists read back from a recording are the same,
+# and the changed values are returned decoded from that JSON so later in-place changes (like MOUSE_DOWN) don't leak in
+def changed_values(last, values):
+    changed = {}
+    for key, value in values.items():
+        encoded = json.dumps(value)
+        if last.get(key) != encoded:
+            last[key] = encoded
+            changed[key] = json.loads(encoded)
+    return changed
+
+
+# the simulation properties stored in a recording (dt is recorded separately for every step)
+def recorded_properties():
+    return {key:value for key,value in simulation_properties.items() if key != 'dt'}
+
+
+# an obstacle shape as stored in a recording
+def recorded_shape(shape):
+    return {key:value for key,value in shape.items() if key != 'footprint'}
+
+
+def start_recording(name):
+    recording = {'name':name, 'step':0, 'events':[], 'last_gui':{}, 'last_properties':{}}
+    recording['lines'] = open(name + '.jsonl', 'w')
+    recording['arrays'] = zipfile.ZipFile(name + '.npz', 'w', compression=zipfile.ZIP_DEFLATED)
+    write_recording_line(recording, {'header':{'properties':recorded_properties(),
+                                               'obstacles':{'slip':obstacle_properties['slip'],
+                                                            'shapes':[recorded_shape(shape) for shape in obstacle_properties['shapes']]},
+                                               'checkpoint_every':replay_properties['checkpoint_every']}})
+    for key in simulation_data:
+        write_recording_array(recording, 'initial_' + key, simulation_data[key])
+    if obstacle_properties['static_source'] is not None:
+        write_recording_array(recording, 'static_source', obstacle_properties['static_source'])
+    changed_values(recording['last_gui'], {key:gui_properties[key] for key in replay_properties['gui_inputs']})
+    changed_values(recording['last_properties'], recorded_properties())
+    replay_properties['recording'] = recording
+
+
+def write_recording_line(recording, line):
+    recording['lines'].write(json.dumps(line) + '\n')
+    recording['lines'].flush()
+
+
+# appends one array to the archive of the recording, in the .npy format numpy.load() reads from a .npz
+def write_recording_array(recording, key, array):
+    with recording['arrays'].open(key + '.npy', 'w', force_zip64=True) as f:
+        np.lib.format.write_array(f, np.asanyarray(array))
+
+
+# notes an input to the simulation that isn't a GUI value or a property, applied by replay() before the next step
+# called by clear_data(), add_obstacle() and remove_obstacle(); does nothing while not recording
+def record_event(event, **arguments):
+    if replay_properties['recording']:
+        replay_properties['recording']['events'].append(dict(arguments, event=event))
+
+
+# records dt and the inputs that changed, called just before simulation_step()
+def record_step_inputs():
+    recording = replay_properties['recording']
+    line = {'dt':simulation_properties['dt'],
+            'gui':changed_values(recording['last_gui'], {key:gui_properties[key] for key in replay_properties['gui_inputs']}),
+            'properties':changed_values(recording['last_properties'], recorded_properties())}
+    if recording['events']:
+        line['events'] = recording['events']
+        recording['events'] = []
+    write_recording_line(recording, line)
+
+
+# hashes the fields and writes a golden snapshot every checkpoint_every steps, called just after simulation_step()
+def record_checkpoint():
+    recording = replay_properties['recording']
+    recording['step'] += 1
+    if recording['step'] % replay_properties['checkpoint_every']:
+        return
+    hashes = {}
+    for field in replay_properties['fields']:
+        hashes[field] = hashlib.sha1(simulation_data[field].tobytes()).hexdigest()
+        write_recording_array(recording, 'step%d_%s' % (recording['step'], field), simulation_data[field])
+    write_recording_line(recording, {'checkpoint':recording['step'], 'hashes':hashes})
+
+
+# closes NAME.jsonl and NAME.npz of the recording in progress. The archive can only be read once it is closed
+# (its zip directory is written last), so this is called when glutMainLoop() returns and registered with atexit
+def stop_recording():
+    recording = replay_properties['recording']
+    if recording is None:
+        return
+    replay_properties['recording'] = None
+    recording['lines'].close()
+    recording['arrays'].close()
+    print('recorded %d steps to %s.jsonl and %s.npz' % (recording['step'], recording['name'], recording['name']))
+
+
+# applies an event read back from a recording, see record_event()
+def replay_event(event):
+    if event['event'] == 'clear':
+        clear_data()
+    elif event['event'] == 'add_obstacle':
+        add_obstacle(dict(event['shape'], footprint=None))
+    elif event['event'] == 'remove_obstacle':
+        remove_obstacle(obstacle_properties['shapes'][event['index']])
+
+
+# replays a recording without opening any windows and compares the fields with the golden snapshots
+# tolerances overrides replay_properties['tolerances'] per field. The time spent in simulation_step() is reported,
+# so a recording of a real session doubles as a benchmark workload
+def replay(name, tolerances=None):
+    with open(name + '.jsonl') as f:
+        lines = [json.loads(line) for line in f]
+    golden = np.load(name + '.npz')
+    header = lines[0]['header']
+    tolerances = dict(replay_properties['tolerances'], **(tolerances or {}))
+
+    if header['properties']['N'] != simulation_properties['N']:
+        resize_simulation(header['properties']['N'])
+    simulation_properties.update(header['properties'])
+    for key in simulation_data:
+        simulation_data[key][:] = golden['initial_' + key]
+    obstacle_properties['slip'] = header['obstacles']['slip']
+    obstacle_properties['shapes'] = [dict(shape, footprint=None) for shape in header['obstacles']['shapes']]
+    obstacle_properties['static_source'] = golden['static_source'] if 'static_source' in golden else None
+    obstacle_properties['dirty'] = True
+
+    steps = 0
+    step_time = 0.0
+    exact = True
+    failures = []
+    for line in lines[1:]:
+        if 'dt' in line:
+            simulation_properties['dt'] = line['dt']
+            gui_properties.update(line['gui'])
+            simulation_properties.update(line['properties'])
+            for event in line.get('events', []):
+                replay_event(event)
+            start = time.perf_counter()
+            simulation_step()
+            step_time += time.perf_counter() - start
+            steps += 1
         else:
-            m[i, 0] = m[i, 1]
-        if b == 2:
-            m[i, N + 1 + (vd=='v')] = -m[i, N + (vd=='v')]
+            for field, digest in line['hashes'].items():
+                exact = exact and hashlib.sha1(simulation_data[field].tobytes()).hexdigest() == digest
+                difference = np.absolute(simulation_data[field] - golden['step%d_%s' % (line['checkpoint'], field)]).max()
+                if not difference <= tolerances[field]: # also catches NaN
+                    failures.append({'step':line['checkpoint'], 'field':field, 'difference':float(difference)})
+
+    print('replayed %d steps in %.3f s (%.2f ms per step), %s' % (steps, step_time, 1000*step_time/max(steps,1),
+          'bit-identical' if exact else 'not bit-identical'))
+    for failure in failures:
+        print('MISMATCH at step %(step)d: %(field)s differs by %(difference).3e' % failure)
+    return {'steps':steps, 'seconds':step_time, 'exact':exact, 'failures':failures}
+
+
+#####################
+# 3D solver
+# the same steps as dens_step() and velocity_step() on N^3 grids. u, v and w are face velocities: u[i,j,k] lies on the
+# face between cells i-1 and i, so the walls are the faces 1 and N+1 along each component's own axis.
+# Scalars and the pressure are cell-centred. Every stencil writes into preallocated arrays
+#####################
+
+# allocates the 3D grids and the thread pool for the slabs
+def allocate_volume(N=None, dtype=None, threads=None):
+    N = N or volume_properties['N']
+    volume_properties['N'] = N
+    volume_properties['dtype'] = dtype or volume_properties['dtype']
+    volume_properties['threads'] = threads or volume_properties['threads']
+    volume_properties['slice'] = N // 2 + 1
+    size = N + 2
+    volume_data.clear()
+    for char,shape in [('u',(size+1,size,size)),('v',(size,size+1,size)),('w',(size,size,size+1))]:
+        volume_data[char] = np.zeros(shape=shape, dtype=volume_properties['dtype'])
+        volume_data[char+'_prev'] = np.zeros(shape=shape, dtype=volume_properties['dtype'])
+    for key in ['red_dens','green_dens','blue_dens','temp']:
+        volume_data[key] = np.zeros(shape=(size,size,size), dtype=volume_properties['dtype'])
+        volume_data[key+'_prev'] = np.zeros(shape=(size,size,size), dtype=volume_properties['dtype'])
+    for key in ['p','div','uc','vc','wc','omega_x','omega_y','omega_z','omega_magnitude']: # pressure, divergence, cell-centred velocity and vorticity
+        volume_data[key] = np.zeros(shape=(size,size,size), dtype=volume_properties['dtype'])
+    if volume_properties['executor'] is not None:
+        volume_properties['executor'].shutdown()
+    volume_properties['executor'] = None
+    if volume_properties['threads'] > 1:
+        volume_properties['executor'] = concurrent.futures.ThreadPoolExecutor(volume_properties['threads'])
+
+
+# returns a 3D scratch array with the given shape, allocated on first use
+def volume_buffer(shape):
+    key = 'scratch_%dx%dx%d' % shape
+    if key not in volume_data:
+        volume_data[key] = np.zeros(shape=shape, dtype=volume_properties['dtype'])
+    return volume_data[key]
+
+
+# calls function(i0, i1, *args) for slabs [i0,i1) that together cover the interior x range 1..N, in parallel
+# each slab function must only write to its own x range
+def run_slabs(function, *args):
+    N = volume_properties['N']
+    bounds = np.linspace(1, N + 1, min(volume_properties['threads'], N) + 1).astype(int)
+    slabs = list(zip(bounds[:-1], bounds[1:]))
+    if volume_properties['executor'] is None:
+        for i0, i1 in slabs:
+            function(i0, i1, *args)
+    else:
+        futures = [volume_properties['executor'].submit(function, i0, i1, *args) for i0, i1 in slabs]
+        for future in futures:
+            future.result() # re-raises anything that went wrong in a slab
+
+
+def dens_step3D():
+    cell_centred_velocity3D(volume_data['u'],volume_data['v'],volume_data['w'])
+    for key,diff,diff_away in [('temp','temp_diff','temp_diff_away'),('red_dens','diff','smoke_diff_away_red'),
+                               ('green_dens','diff','smoke_diff_away_green'),('blue_dens','diff','smoke_diff_away_blue')]:
+        volume_data[key] += volume_data[key+'_prev'] # add_source
+        volume_data[key],volume_data[key+'_prev'] = volume_data[key+'_prev'],volume_data[key] # swap
+        diffuse3D(volume_data[key],volume_data[key+'_prev'],simulation_properties[diff])
+        volume_data[key],volume_data[key+'_prev'] = volume_data[key+'_prev'],volume_data[key] # swap
+        advect3D(volume_data[key],volume_data[key+'_prev'])
+        volume_data[key] *= simulation_properties[diff_away] # diffuse_away
+
+
+def velocity_step3D():
+    dt = simulation_properties['dt']
+    for char in ['u','v','w']:
+        volume_data[char] += dt*volume_data[char+'_prev'] # add_source
+        volume_data[char],volume_data[char+'_prev'] = volume_data[char+'_prev'],volume_data[char] # swap
+        diffuse3D(volume_data[char],volume_data[char+'_prev'],simulation_properties['visc'])
+    project3D()
+    for char in ['u','v','w']:
+        volume_data[char],volume_data[char+'_prev'] = volume_data[char+'_prev'],volume_data[char] # swap
+    cell_centred_velocity3D(volume_data['u_prev'],volume_data['v_prev'],volume_data['w_prev'])
+    for char in ['u','v','w']:
+        advect3D(volume_data[char],volume_data[char+'_prev'])
+    project3D()
+
+    apply_buoyant_force3D()
+    apply_vorticity_confinement3D()
+    project3D()
+
+
+def diffuse3D(m,m0,coeff):
+    N = volume_properties['N']
+    a = simulation_properties['dt'] * coeff * N**2
+    lin_solve3D(m,m0,a,1+6*a)
+
+
+# Jacobi relaxation of c*m - a*(sum of the 6 neighbours of m) = m0, the 3D version of lin_solve()
+# the sweeps alternate between m and a scratch array so the slabs never read what another slab is writing
+def lin_solve3D(m,m0,a,c):
+    N = volume_properties['N']
+    if a == 0: # nothing to relax
+        m[1:N+1,1:N+1,1:N+1] = m0[1:N+1,1:N+1,1:N+1] / c
+        set_bnd3D(m)
+        return
+    src, dst = m, volume_buffer(m.shape)
+    for k in range(simulation_properties['linear_solver_tries']):
+        run_slabs(jacobi_slab3D, dst, src, m0, a, c)
+        set_bnd3D(dst)
+        src, dst = dst, src
+    if src is not m:
+        m[:] = src
+
+
+def jacobi_slab3D(i0, i1, dst, src, m0, a, c):
+    N = volume_properties['N']
+    out = dst[i0:i1,1:N+1,1:N+1]
+    np.add(src[i0-1:i1-1,1:N+1,1:N+1], src[i0+1:i1+1,1:N+1,1:N+1], out=out)
+    out += src[i0:i1,0:N,1:N+1]
+    out += src[i0:i1,2:N+2,1:N+1]
+    out += src[i0:i1,1:N+1,0:N]
+    out += src[i0:i1,1:N+1,2:N+2]
+    out *= a
+    out += m0[i0:i1,1:N+1,1:N+1]
+    out /= c
+
+
+# reflective walls on all six sides. A grid with an extra face along an axis is a velocity component normal to
+# those walls: its wall faces are zero and its ghost faces mirror the inside. Everything else copies its neighbour
+# (free slip for the tangential velocity, no flux for scalars and the pressure)
+def set_bnd3D(m):
+    N = volume_properties['N']
+    for axis in range(3):
+        view = np.moveaxis(m, axis, 0) # a view, so the assignments below write into m
+        if view.shape[0] == N + 3:
+            view[1] = 0.0
+            view[N+1] = 0.0
+            view[0] = -view[2]
+            view[N+2] = -view[N]
         else:
-            m[i, N + 1 + (vd=='v')] = m[i, N + (vd=='v')]
-
-    if vd=='u':
-       i = N+1
-       if b == 2:
-           m[i, 0] = -m[i, 1]
-       else:
-           m[i, 0] = m[i, 1]
-       if b == 2:
-          m[i, N + 1] = -m[i, N]
-       else:
-         m[i, N + 1] = m[i, N]
-    elif vd=='v':
-       i = N+1
-       if b == 1:
-         m[0, i] = -m[1, i]
-       else:
-         m[0, i] = m[1, i]
-       if b == 1:
-         m[N + 1, i] = -m[N, i]
-       else:
-         m[N + 1, i] = m[N, i]
+            view[0] = view[1]
+            view[N+1] = view[N]
+
+
+# averages the face velocities onto the cells (ghosts included) for advect3D()
+def cell_centred_velocity3D(u,v,w):
+    size = volume_properties['N'] + 2
+    for face,cell,axis in [(u,volume_data['uc'],0),(v,volume_data['vc'],1),(w,volume_data['wc'],2)]:
+        face = np.moveaxis(face, axis, 0)
+        np.add(face[0:size], face[1:size+1], out=np.moveaxis(cell, axis, 0))
+        cell *= 0.5
+
+
+# semi-Lagrangian advection of m0 into m by the velocity last given to cell_centred_velocity3D()
+def advect3D(m,m0):
+    N = volume_properties['N']
+    offsets = [-0.5 if m.shape[axis] == N + 3 else 0.0 for axis in range(3)] # faces sit half a cell before their cell
+    run_slabs(advect_slab3D, m, m0, offsets)
+    set_bnd3D(m)
+
+
+# returns a scratch array of the slab starting at x index i0, allocated on first use
+# it holds one chunk of x planes (about chunk_cells cells), so the scratch memory doesn't grow with N^3
+def slab_buffer(i0, name, dtype=None):
+    N = volume_properties['N']
+    key = 'slab%d_%s' % (i0, name)
+    if key not in volume_data:
+        planes = max(1, volume_properties['chunk_cells'] // (N*N))
+        volume_data[key] = np.zeros(shape=(planes,N,N), dtype=dtype or volume_properties['dtype'])
+    return volume_data[key]
+
+
+# advects the slab chunk by chunk, entirely in the slab's scratch arrays and in the dtype of the volume
+def advect_slab3D(i0, i1, m, m0, offsets):
+    N = volume_properties['N']
+    dtype = volume_properties['dtype']
+    dt0 = simulation_properties['dt'] * N
+    planes = slab_buffer(i0, 'x').shape[0]
+    for c0 in range(i0, i1, planes):
+        c1 = min(c0 + planes, i1)
+        x, y, z = [slab_buffer(i0, name)[:c1-c0] for name in ['x','y','z']] # positions in cell units
+        backtrace = [slab_buffer(i0, name)[:c1-c0] for name in ['back_x','back_y','back_z']]
+        x[...] = (np.arange(c0, c1, dtype=dtype) + dtype(offsets[0]))[:, np.newaxis, np.newaxis]
+        y[...] = (np.arange(1, N + 1, dtype=dtype) + dtype(offsets[1]))[np.newaxis, :, np.newaxis]
+        z[...] = (np.arange(1, N + 1, dtype=dtype) + dtype(offsets[2]))[np.newaxis, np.newaxis, :]
+        for back, key in zip(backtrace, ['uc','vc','wc']):
+            if offsets == [0.0, 0.0, 0.0]: # cell centres, no need to interpolate the velocity
+                np.multiply(volume_data[key][c0:c1,1:N+1,1:N+1], dt0, out=back)
+            else:
+                interpolate3D(volume_data[key], x, y, z, i0, back)
+                back *= dt0
+        for position, back in zip([x, y, z], backtrace):
+            position -= back
+            np.clip(position, 0.5, N + 0.5, out=position)
+        for position, offset in zip([x, y, z], offsets):
+            position -= offset
+        m[c0:c1,1:N+1,1:N+1] = interpolate3D(m0, x, y, z, i0, backtrace[0])
+
+
+# trilinear interpolation of m0 at fractional grid positions into out, the 3D version of interpolate()
+# the positions must be positive; the corners are gathered by flat index into the scratch arrays of the slab at i0
+def interpolate3D(m0,x,y,z,i0,out):
+    n = x.shape[0]
+    flat = slab_buffer(i0, 'flat', np.intp)[:n]
+    index = slab_buffer(i0, 'index', np.intp)[:n]
+    fractions = [slab_buffer(i0, name)[:n] for name in ['fx','fy','fz']]
+    a, b, c, d = [slab_buffer(i0, name)[:n] for name in ['a','b','c','d']]
+    flat[...] = 0
+    for position, fraction, stride in zip([x, y, z], fractions, [m0.shape[1], m0.shape[2], 1]):
+        np.floor(position, out=fraction)
+        np.copyto(index, fraction, casting='unsafe')
+        flat += index
+        flat *= stride
+        np.subtract(position, fraction, out=fraction)
+    fx, fy, fz = fractions
+    values = m0.reshape(-1) # a view, the grids are contiguous
+    di, dj = m0.shape[1] * m0.shape[2], m0.shape[2]
+
+    for corner, target in [(0, out), (dj, a), (di, b), (di + dj, c)]: # lerp along z from the four corners (i0|i0+1, j0|j0+1, k0)
+        np.add(flat, corner, out=index)
+        np.take(values, index, out=target, mode='clip')
+        index += 1
+        np.take(values, index, out=d, mode='clip')
+        d -= target
+        d *= fz
+        target += d
+    a -= out # along y
+    a *= fy
+    out += a
+    c -= b
+    c *= fy
+    b += c
+    b -= out # along x
+    b *= fx
+    out += b
+    return out
+
+
+# makes the face velocities divergence-free. On the staggered grid the divergence of a cell is the difference of its
+# face velocities, so unlike project() the pressure gradient removes the divergence up to the relaxation error
+def project3D():
+    N = volume_properties['N']
+    h = 1.0 / N
+    p = volume_data['p']
+    div = volume_data['div']
+    run_slabs(divergence_slab3D, div, h)
+    p[:] = 0.0
+    set_bnd3D(div)
+    lin_solve3D(p,div,1,6)
+    run_slabs(gradient_slab3D, h)
+    for char in ['u','v','w']:
+        set_bnd3D(volume_data[char])
+
+
+def divergence_slab3D(i0, i1, div, h):
+    N = volume_properties['N']
+    u, v, w = volume_data['u'], volume_data['v'], volume_data['w']
+    out = div[i0:i1,1:N+1,1:N+1]
+    np.subtract(u[i0+1:i1+1,1:N+1,1:N+1], u[i0:i1,1:N+1,1:N+1], out=out)
+    out += v[i0:i1,2:N+2,1:N+1]
+    out -= v[i0:i1,1:N+1,1:N+1]
+    out += w[i0:i1,1:N+1,2:N+2]
+    out -= w[i0:i1,1:N+1,1:N+1]
+    out *= -h
+
+
+# subtracts the pressure gradient from the inner faces (the wall faces stay zero)
+def gradient_slab3D(i0, i1, h):
+    N = volume_properties['N']
+    p = volume_data['p']
+    f0 = max(i0, 2) # u faces of this slab that lie between two cells
+    volume_data['u'][f0:i1,1:N+1,1:N+1] -= (p[f0:i1,1:N+1,1:N+1] - p[f0-1:i1-1,1:N+1,1:N+1]) / h
+    volume_data['v'][i0:i1,2:N+1,1:N+1] -= (p[i0:i1,2:N+1,1:N+1] - p[i0:i1,1:N,1:N+1]) / h
+    volume_data['w'][i0:i1,1:N+1,2:N+1] -= (p[i0:i1,1:N+1,2:N+1] - p[i0:i1,1:N+1,1:N]) / h
+
+
+# buoyancy pushes the inner v faces up in proportion to the temperature of the two cells they separate
+def apply_buoyant_force3D():
+    N = volume_properties['N']
+    temp = volume_data['temp']
+    scale = 0.5*simulation_properties['buoyancy']*simulation_properties['dt']
+    volume_data['v'][1:N+1,2:N+1,1:N+1] += scale*(temp[1:N+1,1:N,1:N+1] + temp[1:N+1,2:N+1,1:N+1])
+
+
+# the 3D version of apply_vorticity_confinement(): the force is epsilon*h*(N x omega), N the unit gradient of |omega|
+# runs in three passes over the slabs, because the gradient of |omega| and the face averages of the force read the
+# neighbouring slabs. omega_x/y/z hold the vorticity and then the force, omega_magnitude holds |omega|
+def apply_vorticity_confinement3D():
+    N = volume_properties['N']
+    h = 1.0 / N
+    scale = simulation_properties['vorticity_confinement_constant'] * h * 0.5 * simulation_properties['dt'] # 0.5 for the face averages
+    cell_centred_velocity3D(volume_data['u'],volume_data['v'],volume_data['w'])
+    run_slabs(curl_slab3D)
+    # linear extrapolation into the ghost cells, so the central differences of |omega| are one-sided on the edges
+    for axis in range(3):
+        view = np.moveaxis(volume_data['omega_magnitude'], axis, 0)[:, 1:N+1, 1:N+1]
+        np.multiply(view[1], 2, out=view[0])
+        view[0] -= view[2]
+        np.multiply(view[N], 2, out=view[N+1])
+        view[N+1] -= view[N-1]
+    run_slabs(confinement_slab3D, scale)
+    run_slabs(confinement_faces_slab3D)
+
+
+# vorticity of the cell-centred velocity and its magnitude on the interior cells of the slab, by central differences
+def curl_slab3D(i0, i1):
+    N = volume_properties['N']
+    h2 = 2.0 / N
+    uc, vc, wc = volume_data['uc'], volume_data['vc'], volume_data['wc']
+    I, J = slice(i0,i1), slice(1,N+1)
+    ox, oy, oz = [volume_data[key][I,J,J] for key in ['omega_x','omega_y','omega_z']]
+    np.subtract(wc[I,2:N+2,J], wc[I,0:N,J], out=ox)
+    ox -= vc[I,J,2:N+2]
+    ox += vc[I,J,0:N]
+    ox /= h2
+    np.subtract(uc[I,J,2:N+2], uc[I,J,0:N], out=oy)
+    oy -= wc[i0+1:i1+1,J,J]
+    oy += wc[i0-1:i1-1,J,J]
+    oy /= h2
+    np.subtract(vc[i0+1:i1+1,J,J], vc[i0-1:i1-1,J,J], out=oz)
+    oz -= uc[I,2:N+2,J]
+    oz += uc[I,0:N,J]
+    oz /= h2
+    planes = slab_buffer(i0, 'a').shape[0]
+    for c0 in range(0, i1 - i0, planes):
+        c1 = min(c0 + planes, i1 - i0)
+        vector_length3D(ox[c0:c1], oy[c0:c1], oz[c0:c1], volume_data['omega_magnitude'][i0+c0:i0+c1,J,J], slab_buffer(i0, 'a')[:c1-c0])
+
+
+# out = sqrt(x^2 + y^2 + z^2) without temporaries, scratch is an array shaped like out
+def vector_length3D(x, y, z, out, scratch):
+    np.multiply(x, x, out=out)
+    np.multiply(y, y, out=scratch)
+    out += scratch
+    np.multiply(z, z, out=scratch)
+    out += scratch
+    np.sqrt(out, out=out)
+
+
+# replaces the vorticity of the slab with the confinement force times scale, chunk by chunk in the slab's scratch arrays
+# only the slab's own cells of omega_x/y/z are read and written, |omega| is only read
+def confinement_slab3D(i0, i1, scale):
+    N = volume_properties['N']
+    h2 = 2.0 / N
+    magnitude = volume_data['omega_magnitude']
+    planes = slab_buffer(i0, 'x').shape[0]
+    J = slice(1,N+1)
+    for c0 in range(i0, i1, planes):
+        c1 = min(c0 + planes, i1)
+        eta = [slab_buffer(i0, name)[:c1-c0] for name in ['x','y','z']]
+        cross = [slab_buffer(i0, name)[:c1-c0] for name in ['back_x','back_y','back_z']]
+        length = slab_buffer(i0, 'a')[:c1-c0]
+        product = slab_buffer(i0, 'b')[:c1-c0]
+        np.subtract(magnitude[c0+1:c1+1,J,J], magnitude[c0-1:c1-1,J,J], out=eta[0])
+        np.subtract(magnitude[c0:c1,2:N+2,J], magnitude[c0:c1,0:N,J], out=eta[1])
+        np.subtract(magnitude[c0:c1,J,2:N+2], magnitude[c0:c1,J,0:N], out=eta[2])
+        for component in eta:
+            component /= h2
+        vector_length3D(eta[0], eta[1], eta[2], length, product)
+        length += 1e-20 # prevent divide by zero errors
+        for component in eta:
+            component /= length
+        omega = [volume_data[key][c0:c1,J,J] for key in ['omega_x','omega_y','omega_z']]
+        for k in range(3): # cross[k] = eta[k+1]*omega[k+2] - eta[k+2]*omega[k+1]
+            np.multiply(eta[(k+1)%3], omega[(k+2)%3], out=cross[k])
+            np.multiply(eta[(k+2)%3], omega[(k+1)%3], out=product)
+            cross[k] -= product
+        for k in range(3):
+            np.multiply(cross[k], scale, out=omega[k])
+
+
+# each inner face of the slab gets the average of the (already halved) forces on its two cells
+def confinement_faces_slab3D(i0, i1):
+    N = volume_properties['N']
+    force_x, force_y, force_z = volume_data['omega_x'], volume_data['omega_y'], volume_data['omega_z']
+    J = slice(1,N+1)
+    a = max(i0, 2) # face 1 is the wall
+    volume_data['u'][a:i1,J,J] += force_x[a-1:i1-1,J,J]
+    volume_data['u'][a:i1,J,J] += force_x[a:i1,J,J]
+    volume_data['v'][i0:i1,2:N+1,J] += force_y[i0:i1,1:N,J]
+    volume_data['v'][i0:i1,2:N+1,J] += force_y[i0:i1,2:N+1,J]
+    volume_data['w'][i0:i1,J,2:N+1] += force_z[i0:i1,J,1:N]
+    volume_data['w'][i0:i1,J,2:N+1] += force_z[i0:i1,J,2:N+1]
+
+
+# mouse input for the 3D solver, added in the displayed z slice like get_from_UI() does in 2D
+def get_from_UI3D():
+    N = volume_properties['N']
+    k = volume_properties['slice']
+    for key in ['u_prev','v_prev','w_prev','red_dens_prev','green_dens_prev','blue_dens_prev','temp_prev']:
+        volume_data[key][:] = 0.0
 
+    if not gui_properties['MOUSE_DOWN'][GLUT_LEFT_BUTTON] and not gui_properties['MOUSE_DOWN'][GLUT_RIGHT_BUTTON]:
+        return
+    i, j = mouse_cell(N)
+    if i < 1 or i > N or j < 1 or j > N:
+        return
+
+    if gui_properties['MOUSE_DOWN'][GLUT_LEFT_BUTTON]:
+        volume_data['u_prev'][i:i+2, j, k] = 0.5*simulation_properties['force'] * (gui_properties['MOUSE_X'] - gui_properties['ORIG_MOUSE_X']) # both faces of the cell
+        volume_data['v_prev'][i, j:j+2, k] = 0.5*simulation_properties['force'] * (gui_properties['ORIG_MOUSE_Y'] - gui_properties['MOUSE_Y'])
+    elif gui_properties['MOUSE_DOWN'][GLUT_RIGHT_BUTTON]:
+        SMOKE_COLOR = gui_properties['SMOKE_COLOR']
+        volume_data['red_dens_prev'][i, j, k] = simulation_properties['dens_source']*SMOKE_COLOR[0]/255
+        volume_data['green_dens_prev'][i, j, k] = simulation_properties['dens_source']*SMOKE_COLOR[1]/255
+        volume_data['blue_dens_prev'][i, j, k] = simulation_properties['dens_source']*SMOKE_COLOR[2]/255
+        volume_data['temp_prev'][i, j, k] = (simulation_properties['temp_source_red']*SMOKE_COLOR[0]/255 + simulation_properties['temp_source_green']*SMOKE_COLOR[1]/255 +
+                                             simulation_properties['temp_source_blue']*SMOKE_COLOR[2]/255)
+    gui_properties['ORIG_MOUSE_X'] = gui_properties['MOUSE_X']
+    gui_properties['ORIG_MOUSE_Y'] = gui_properties['MOUSE_Y']
+
+
+def simulation_step3D():
+    get_from_UI3D()
+    dens_step3D()
+    velocity_step3D()
+
+
+# shows the displayed z slice of the volume with the 2D drawing routines
+def draw_volume_slice():
+    k = volume_properties['slice']
+    if gui_properties['DISPLAY_VELOCITY']:
+        draw_velocity(volume_data['u'][:, :, k], volume_data['v'][:, :, k], volume_properties['N'])
+    else:
+        draw_density(volume_data['red_dens'][:, :, k], volume_data['green_dens'][:, :, k], volume_data['blue_dens'][:, :, k])
+
+
+# reallocates the simulation grids for a new N, clearing all data
+def resize_simulation(N):
+    global size
+    simulation_properties['N'] = N
+    simulation_properties['size'] = N + 2
+    size = simulation_properties['size']
+    for key in list(simulation_data.keys()):
+        grid_size = size + 1 if key[0] in 'uv' else size # u and v grids are staggered
+        simulation_data[key] = np.zeros(shape=(grid_size,grid_size), dtype=(np.float64))
+    obstacle_properties['dirty'] = True
+    build_obstacle_index()
+
+
+# times project() and diffuse() with relaxation and with the spectral solver on a periodic domain
+# and reports the largest divergence (as project() measures it) before and after the projection
+def benchmark_solvers(sizes=(64, 128, 256, 512, 1024), repeats=5):
+    saved = (simulation_properties['N'], simulation_properties['boundary_modes'], simulation_properties['linear_solver_mode'], simulation_properties['dt'])
+    set_boundary_modes(left='periodic', right='periodic', bottom='periodic', top='periodic')
+    simulation_properties['dt'] = 0.02
+    print('%6s %-11s %14s %14s %14s %14s' % ('N', 'solver', 'project (ms)', 'diffuse (ms)', 'div before', 'div after'))
+    for N in sizes:
+        resize_simulation(N)
+        rng = np.random.default_rng(0)
+        u0 = rng.standard_normal(simulation_data['u'].shape)
+        v0 = rng.standard_normal(simulation_data['v'].shape)
+        d0 = rng.random(simulation_data['red_dens'].shape)
+        div = np.zeros_like(u0)
+        set_bnd(1,u0,vd='u') # wrap the random velocity so its divergence has no mean component
+        set_bnd(2,v0,vd='v')
+        for mode in ('relaxation', 'spectral'):
+            simulation_properties['linear_solver_mode'] = mode
+            project_time = diffuse_time = 0.0
+            for k in range(repeats):
+                simulation_data['u'][:] = u0
+                simulation_data['v'][:] = v0
+                compute_divergence(div)
+                before = np.absolute(div[1:N+1,1:N+1]).max()
+                start = time.perf_counter()
+                project()
+                project_time += time.perf_counter() - start
+                start = time.perf_counter()
+                diffuse(simulation_data['red_dens'], d0, 0, 1e-4)
+                diffuse_time += time.perf_counter() - start
+            compute_divergence(div)
+            print('%6d %-11s %14.2f %14.2f %14.3e %14.3e' % (N, mode, 1000*project_time/repeats, 1000*diffuse_time/repeats,
+                                                             before, np.absolute(div[1:N+1,1:N+1]).max()))
+    resize_simulation(saved[0])
+    simulation_properties['boundary_modes'], simulation_properties['linear_solver_mode'], simulation_properties['dt'] = saved[1:]
 
-    # setting bounds on corners
-    m[0, 0] = 0.5 * (m[1, 0] + m[0, 1])
-    m[0, N + 1 + (vd=='v')] = 0.5 * (m[1, N + 1 + (vd=='v')] + m[0, N + (vd=='v')])
-    m[N + 1 + (vd=='u'), 0] = 0.5 * (m[N + (vd=='u'), 0] + m[N + 1 + (vd=='u'), 1])
-    m[N + 1 + (vd=='u'), N + 1 + (vd=='v')] = 0.5 * (m[N + (vd=='u'), N + 1 + (vd=='v')] + m[N + 1 + (vd=='u'), N + (vd=='v')])
 
 def main():
 
+    parser = argparse.ArgumentParser(description='Interactive fluid solver with a staggered grid')
+    parser.add_argument('--benchmark', action='store_true', help='benchmark the relaxation and spectral solvers and exit')
+    parser.add_argument('--diagnostics-every', type=int, default=0, metavar='STEPS', help='record diagnostics every STEPS steps')
+    parser.add_argument('--diagnostics-out', metavar='PATH', help='write the diagnostics to PATH (.csv or JSON lines) on exit')
+    parser.add_argument('--diagnostics-port', type=int, metavar='PORT', help='stream the diagnostics to monitors on localhost:PORT')
+    parser.add_argument('--3d', dest='volume', action='store_true', help='run the volumetric solver and show one z slice of it')
+    parser.add_argument('--3d-size', dest='volume_size', type=int, default=volume_properties['N'], metavar='N', help='cells per side of the 3D grid')
+    parser.add_argument('--float32', action='store_true', help='store the 3D grids as float32')
+    parser.add_argument('--threads', type=int, default=volume_properties['threads'], help='threads running the slabs of the 3D solver')
+    parser.add_argument('--record', metavar='NAME', help='record the session to NAME.jsonl and NAME.npz')
+    parser.add_argument('--replay', metavar='NAME', help='replay a recording headlessly, compare it with its golden snapshots and exit')
+    parser.add_argument('--tolerance', action='append', default=[], metavar='FIELD=VALUE', help='replay tolerance for one field, can be repeated')
+    parser.add_argument('--boundary', action='append', default=[], metavar='EDGE=MODE', help='boundary mode (wall, periodic, inflow or outflow) of the left, right, bottom or top edge, can be repeated')
+    parser.add_argument('--inflow', action='append', default=[], metavar='EDGE=U,V', help='velocity coming in through an inflow edge, can be repeated')
+    parser.add_argument('--obstacles', metavar='PATH', help='load a static obstacle mask from an image, dark pixels are solid')
+    numbers = lambda text: [float(value) for value in text.split(',')]
+    numbers.__name__ = 'comma-separated numbers' # shown by argparse when a value doesn't parse
+    parser.add_argument('--obstacle-rect', action='append', default=[], type=numbers, metavar='X,Y,W,H[,VX,VY]', help='add a rectangular obstacle in window units, can be repeated')
+    parser.add_argument('--obstacle-circle', action='append', default=[], type=numbers, metavar='X,Y,R[,VX,VY]', help='add a circular obstacle in window units, can be repeated')
+    parser.add_argument('--obstacle-slip', choices=['free','no'], default=obstacle_properties['slip'], help='slip condition on the obstacle surfaces')
+    args = parser.parse_known_args()[0] # anything else is left for GLUT
+    if args.volume: # recording, replay, diagnostics, the solver benchmark, obstacles and boundary modes only exist for the 2D solver
+        flags_2D = [('--record', args.record), ('--replay', args.replay), ('--benchmark', args.benchmark), ('--diagnostics-every', args.diagnostics_every), ('--diagnostics-out', args.diagnostics_out),
+                    ('--diagnostics-port', args.diagnostics_port), ('--obstacles', args.obstacles), ('--obstacle-rect', args.obstacle_rect),
+                    ('--obstacle-circle', args.obstacle_circle), ('--boundary', args.boundary), ('--inflow', args.inflow)]
+        for flag, value in flags_2D:
+            if value:
+                parser.error(flag + ' is not supported with --3d')
+    if args.benchmark:
+        benchmark_solvers()
+        return
+    if args.diagnostics_out or args.diagnostics_port:
+        diagnostics_properties['every'] = args.diagnostics_every or 1
+    else:
+        diagnostics_properties['every'] = args.diagnostics_every
+    diagnostics_properties['output'] = args.diagnostics_out
+    if args.diagnostics_port:
+        start_diagnostics_server(args.diagnostics_port)
+    atexit.register(finish_diagnostics)
+    if args.replay:
+        tolerances = {}
+        for tolerance in args.tolerance:
+            field, value = tolerance.partition('=')[::2]
+            try:
+                tolerances[field] = float(value)
+            except ValueError:
+                parser.error('--tolerance takes FIELD=VALUE with a number as VALUE')
+            if field not in replay_properties['fields']:
+                parser.error('--tolerance fields are ' + ', '.join(replay_properties['fields']))
+        sys.exit(1 if replay(args.replay, tolerances)['failures'] else 0)
+
+    modes = dict(boundary.partition('=')[::2] for boundary in args.boundary)
+    if set(modes) - set(simulation_properties['boundary_modes']):
+        parser.error('--boundary takes EDGE=MODE with EDGE one of left, right, bottom or top')
+    try:
+        set_boundary_modes(**modes)
+    except ValueError as error:
+        parser.error(str(error))
+    for inflow in args.inflow:
+        edge, velocity = inflow.partition('=')[::2]
+        try:
+            velocity = tuple(float(value) for value in velocity.split(','))
+        except ValueError:
+            velocity = ()
+        if edge not in simulation_properties['inflow_velocity'] or len(velocity) != 2:
+            parser.error('--inflow takes EDGE=U,V with EDGE one of left, right, bottom or top')
+        simulation_properties['inflow_velocity'][edge] = velocity
+
+    obstacle_properties['slip'] = args.obstacle_slip
+    if args.obstacles:
+        load_obstacle_mask(args.obstacles)
+    for rect in args.obstacle_rect:
+        if len(rect) not in (4, 6):
+            parser.error('--obstacle-rect takes X,Y,W,H or X,Y,W,H,VX,VY')
+        add_obstacle_rect(*rect)
+    for circle in args.obstacle_circle:
+        if len(circle) not in (3, 5):
+            parser.error('--obstacle-circle takes X,Y,R or X,Y,R,VX,VY')
+        add_obstacle_circle(*circle)
+
+    if args.volume:
+        allocate_volume(args.volume_size, np.float32 if args.float32 else np.float64, args.threads)
+        volume_properties['enabled'] = True
+
     glutInit()
     clear_data()
+    if args.record:
+        start_recording(args.record)
+        atexit.register(stop_recording)
     open_glut_window()
     glutMainLoop()
+    finish_diagnostics() # the GLUT window was closed
+    stop_recording()
 
 
 